@@ -1,97 +1,433 @@
-from flask import Flask, jsonify, Response
+from flask import Flask, jsonify, Response, request
 import re
-import matplotlib
-matplotlib.use('Agg')  # Use non-interactive backend to avoid UI thread issues
-import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import hashlib
 import io
+import math
 import os
+import pickle
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from datetime import datetime
 
 app = Flask(__name__)
 
-# Path to the file storing historical data
-HISTORICAL_DATA_FILE = "gpu_hw_residency_history.txt"
+# Bars shown by /gpu_metrics_chart (one per 10 s rollup bucket)
 MAX_OBSERVATIONS = 20
+# powermetrics output, appended to continuously (see README)
+POWER_METRICS_FILE = "gpu_power_metrics.txt"
+# Bytes read from the end of an existing log on the first poll
+INITIAL_TAIL_BYTES = 64 * 1024
+# How often the sampler thread polls the log
+SAMPLE_INTERVAL_SECONDS = 2
+# Path to the file storing historical data, and how often it is rewritten
+STORE_SNAPSHOT_FILE = "gpu_metrics_store.pickle"
+STORE_SNAPSHOT_INTERVAL_SECONDS = 60
+# Rollup tiers as (bucket seconds, buckets kept): 10 s for 6 h, 1 min for 3 days, 1 h for 90 days
+ROLLUP_TIERS = ((10, 2160), (60, 4320), (3600, 2160))
+# Largest number of points a /gpu_metrics/range query may return
+MAX_RANGE_POINTS = 5000
+# /gpu_metrics_chart size limits in pixels, and how many rendered variants are kept
+CHART_DEFAULT_SIZE = (1200, 600)
+CHART_MIN_SIDE = 50
+CHART_MAX_SIDE = 4000
+CHART_DPI = 100
+CHART_CACHE_ENTRIES = 16
 
-def parse_latest_gpu_hw_residency(file_path):
-    # Regular expression to capture the GPU HW active residency percentage
-    pattern = r"GPU HW active residency:\s+([\d\.]+)%"
-    latest_value = None
-    
-    with open(file_path, "r") as file:
-        for line in file:
-            match = re.search(pattern, line)
-            if match:
-                latest_value = float(match.group(1))
-
-    return latest_value
-
-def save_to_historical_data(value):
-    # Read current historical data
-    historical_data = get_historical_data()
-
-    # Append the latest value
-    historical_data.append(value)
-
-    # Keep only the last MAX_OBSERVATIONS values
-    if len(historical_data) > MAX_OBSERVATIONS:
-        historical_data = historical_data[-MAX_OBSERVATIONS:]
-
-    # Write the updated historical data back to the file
-    with open(HISTORICAL_DATA_FILE, "w") as file:
-        for val in historical_data:
-            file.write(f"{val}\n")
-
-def get_historical_data():
-    # Read historical data from the file
-    if not os.path.exists(HISTORICAL_DATA_FILE):
-        return []
-
-    with open(HISTORICAL_DATA_FILE, "r") as file:
-        data = [float(line.strip()) for line in file if line.strip().isdigit() or re.match(r'^\d+(\.\d+)?$', line.strip())]
-    
-    return data
+class PowerMetricsTail:
+    """
+    Follows the powermetrics log like `tail -f`. Each poll reads only the bytes
+    appended since the previous poll and returns the newly completed lines.
+    If the inode changes (rotation) or the file becomes shorter than the saved
+    offset (truncation), reading restarts from the top of the new file.
+    """
+    def __init__(self, file_path, initial_tail_bytes):
+        self.file_path = file_path
+        self.initial_tail_bytes = initial_tail_bytes
+        self._inode = None
+        self._offset = 0
+        self._partial_line = b""
+        self._lock = threading.Lock()
+
+    def poll(self):
+        with self._lock:
+            try:
+                file = open(self.file_path, "rb")
+            except FileNotFoundError:
+                return []
+
+            with file:
+                stat = os.fstat(file.fileno())
+                if self._inode is None and stat.st_size > self.initial_tail_bytes:
+                    # First open of a large existing log: only its tail holds recent samples
+                    file.seek(stat.st_size - self.initial_tail_bytes)
+                    file.readline()  # Drop the line the seek landed in
+                elif self._inode is not None and stat.st_ino == self._inode and stat.st_size >= self._offset:
+                    file.seek(self._offset)
+                else:
+                    self._partial_line = b""  # New file (rotated) or truncated: start over
+                self._inode = stat.st_ino
+                chunk = file.read()
+                self._offset = file.tell()
+
+            lines = (self._partial_line + chunk).split(b"\n")
+            self._partial_line = lines.pop()  # Incomplete until powermetrics writes its newline
+            return [line.decode("utf-8", errors="replace") for line in lines]
+
+
+class PowerMetricsParser:
+    """
+    Turns powermetrics `gpu_power` lines into (timestamp, metric, value) samples.
+    Every "Label: value unit" line is one metric, named by its snake-cased
+    label plus its unit (e.g. `gpu_power_mw`, `gpu_hw_active_frequency_mhz`).
+    Percentages have no suffix (e.g. `gpu_hw_active_residency`). Breakdowns in
+    parentheses, such as the per-frequency residency or the P-state shares,
+    become one metric each, e.g. `gpu_hw_active_residency_389_mhz` and
+    `gpu_sw_state_sw_p1`. Samples are timestamped from the
+    "*** Sampled system activity (...)" header that precedes them.
+    """
+    HEADER_PATTERN = re.compile(r"^\*\*\* Sampled system activity \((.+?)\)")
+    METRIC_PATTERN = re.compile(r"^([A-Za-z][\w ]*?):\s*(?:([\d\.]+)\s*(%|[A-Za-z]+)?)?\s*(?:\((.*)\))?\s*$")
+    BREAKDOWN_PATTERN = re.compile(r"([\w ]+?)\s*:\s*([\d\.]+)%")
+
+    def __init__(self):
+        self.sampled_at = None
+        self.latest = {}  # metric -> latest value
+        self.latest_sampled_at = None
+
+    @staticmethod
+    def metric_name(*parts):
+        return re.sub(r"[^a-z0-9]+", "_", " ".join(parts).lower()).strip("_")
+
+    def feed(self, lines):
+        samples = []
+        for line in lines:
+            line = line.strip()
+            header = self.HEADER_PATTERN.match(line)
+            if header:
+                try:
+                    self.sampled_at = datetime.strptime(header.group(1), "%a %b %d %H:%M:%S %Y %z").timestamp()
+                except ValueError:
+                    self.sampled_at = None
+                continue
+            match = self.METRIC_PATTERN.match(line)
+            if not match:
+                continue
+            label, value, unit, breakdown = match.groups()
+            timestamp = self.sampled_at or time.time()
+            if value is not None:
+                suffix = unit if unit and unit != "%" else ""
+                samples.append((timestamp, self.metric_name(label, suffix), float(value)))
+            for key, share in self.BREAKDOWN_PATTERN.findall(breakdown or ""):
+                samples.append((timestamp, self.metric_name(label, key), float(share)))
+        for timestamp, metric, value in samples:
+            self.latest[metric] = value
+            self.latest_sampled_at = timestamp
+        return samples
+
+
+class RollupTier:
+    """
+    Fixed-size ring of time buckets for one metric at one resolution. Each
+    bucket stores min, max, sum and count in flat typed arrays, so a tier costs
+    28 bytes per bucket no matter how many samples land in it.
+    """
+    def __init__(self, step, capacity):
+        self.step = step
+        self.capacity = capacity
+        self.newest = -1  # Newest bucket number written
+        self.buckets = array("q", [-1]) * capacity  # Bucket number held by each slot
+        self.mins = array("f", [0.0]) * capacity
+        self.maxs = array("f", [0.0]) * capacity
+        self.sums = array("d", [0.0]) * capacity
+        self.counts = array("I", [0]) * capacity
+
+    def add(self, timestamp, value):
+        bucket = int(timestamp // self.step)
+        if bucket <= self.newest - self.capacity:
+            return  # Older than this tier keeps
+        slot = bucket % self.capacity
+        if self.buckets[slot] != bucket:
+            self.buckets[slot] = bucket
+            self.mins[slot] = self.maxs[slot] = value
+            self.sums[slot] = 0.0
+            self.counts[slot] = 0
+        self.mins[slot] = min(self.mins[slot], value)
+        self.maxs[slot] = max(self.maxs[slot], value)
+        self.sums[slot] += value
+        self.counts[slot] += 1
+        self.newest = max(self.newest, bucket)
+
+    def oldest_time(self):
+        return (self.newest - self.capacity + 1) * self.step
+
+    def read(self, start, end):
+        """Yields (bucket start time, min, max, sum, count) for the filled buckets in [start, end)."""
+        first = max(int(start // self.step), self.newest - self.capacity + 1)
+        last = min(math.ceil(end / self.step) - 1, self.newest)
+        for bucket in range(first, last + 1):
+            slot = bucket % self.capacity
+            if self.buckets[slot] == bucket:
+                yield bucket * self.step, self.mins[slot], self.maxs[slot], self.sums[slot], self.counts[slot]
+
+
+class TimeSeriesStore:
+    """
+    Every sample is added to each rollup tier of its metric. A range query reads
+    the finest tier that still covers the start of the range and merges its
+    buckets up to the requested step. `version` increases with every sample.
+    """
+    def __init__(self, tiers):
+        self.tiers = tiers
+        self.series = {}  # metric -> [RollupTier per tier]
+        self.version = 0
+        self._lock = threading.Lock()
+
+    def add(self, metric, timestamp, value):
+        with self._lock:
+            if metric not in self.series:
+                self.series[metric] = [RollupTier(step, capacity) for step, capacity in self.tiers]
+            for tier in self.series[metric]:
+                tier.add(timestamp, value)
+            self.version += 1
+
+    def metrics(self):
+        with self._lock:
+            return sorted(self.series)
+
+    def query(self, metric, start, end, step=None):
+        """Returns (step, points) with one {"t", "min", "max", "avg", "count"} point per step. Raises KeyError for unknown metrics."""
+        with self._lock:
+            tiers = self.series[metric]
+            covering = [tier for tier in tiers if tier.oldest_time() <= start] or tiers[-1:]
+            fine_enough = [tier for tier in covering if step is not None and tier.step <= step]
+            tier = fine_enough[-1] if fine_enough else covering[0]  # Coarsest tier that still resolves the step
+            step = tier.step if step is None else math.ceil(step / tier.step) * tier.step
+            if (end - start) / step > MAX_RANGE_POINTS:
+                raise ValueError(f"Range would return more than {MAX_RANGE_POINTS} points; increase step.")
+            merged = {}
+            for bucket_start, low, high, total, count in tier.read(start, end):
+                t = bucket_start // step * step
+                if t in merged:
+                    point = merged[t]
+                    point[0] = min(point[0], low)
+                    point[1] = max(point[1], high)
+                    point[2] += total
+                    point[3] += count
+                else:
+                    merged[t] = [low, high, total, count]
+        points = [
+            {"t": t, "min": round(low, 3), "max": round(high, 3), "avg": round(total / count, 3), "count": count}
+            for t, (low, high, total, count) in sorted(merged.items())
+        ]
+        return step, points
+
+    def save(self, file_path):
+        # Written next to the target and renamed over it, so a crash never leaves a half-written snapshot
+        with self._lock:
+            state = pickle.dumps((self.tiers, {
+                metric: [(tier.newest, tier.buckets, tier.mins, tier.maxs, tier.sums, tier.counts) for tier in tiers]
+                for metric, tiers in self.series.items()
+            }))
+        temp_path = f"{file_path}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(state)
+        os.replace(temp_path, file_path)
+
+    def load(self, file_path):
+        if not os.path.exists(file_path):
+            return
+        try:
+            with open(file_path, "rb") as file:
+                tiers, saved_series = pickle.load(file)
+        except Exception as e:
+            app.logger.warning(f"Ignoring unreadable metrics snapshot {file_path}: {e}")
+            return
+        if tuple(tiers) != tuple(self.tiers):
+            return  # Snapshots from a different tier layout are dropped
+        series = {}
+        for metric, saved_tiers in saved_series.items():
+            series[metric] = []
+            for (step, capacity), (newest, buckets, mins, maxs, sums, counts) in zip(self.tiers, saved_tiers):
+                tier = RollupTier(step, capacity)
+                tier.newest, tier.buckets, tier.mins, tier.maxs, tier.sums, tier.counts = newest, buckets, mins, maxs, sums, counts
+                series[metric].append(tier)
+        with self._lock:
+            self.series = series
+
+
+class MetricsSampler:
+    """Background thread that polls the powermetrics log into the store and snapshots the store to disk."""
+    def __init__(self, tail, parser, store, interval, snapshot_path, snapshot_interval):
+        self.tail = tail
+        self.parser = parser
+        self.store = store
+        self.interval = interval
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="gpu-metrics-sampler", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def sample_once(self):
+        for timestamp, metric, value in self.parser.feed(self.tail.poll()):
+            self.store.add(metric, timestamp, value)
+
+    def _run(self):
+        last_snapshot = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                self.sample_once()
+                if time.monotonic() - last_snapshot >= self.snapshot_interval:
+                    self.store.save(self.snapshot_path)
+                    last_snapshot = time.monotonic()
+            except Exception as e:
+                app.logger.error(f"GPU metrics sampling failed: {e}")
+            self._stop.wait(self.interval)
+        self.store.save(self.snapshot_path)
+
+
+parser = PowerMetricsParser()
+store = TimeSeriesStore(ROLLUP_TIERS)
+store.load(STORE_SNAPSHOT_FILE)
+sampler = MetricsSampler(
+    PowerMetricsTail(POWER_METRICS_FILE, INITIAL_TAIL_BYTES), parser, store,
+    SAMPLE_INTERVAL_SECONDS, STORE_SNAPSHOT_FILE, STORE_SNAPSHOT_INTERVAL_SECONDS,
+)
+
+# Read what the log already holds before serving, so the first request has data. Under `python gpu-usage.py`
+# the debug reloader's watcher process imports this module too; only its serving child (WERKZEUG_RUN_MAIN) samples.
+if __name__ != '__main__' or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+    sampler.sample_once()
+    sampler.start()
 
 @app.route('/gpu_metrics', methods=['GET'])
 def gpu_metrics():
-    file_path = "gpu_power_metrics.txt"
-    gpu_hw_residency = parse_latest_gpu_hw_residency(file_path)
-    
-    if gpu_hw_residency is not None:
-        save_to_historical_data(gpu_hw_residency)
-    
+    gpu_hw_residency = parser.latest.get("gpu_hw_active_residency")
+
     # Return JSON response
     response = {
-        "gpu_hw_active_residency": gpu_hw_residency if gpu_hw_residency is not None else "Not found"
+        "gpu_hw_active_residency": gpu_hw_residency if gpu_hw_residency is not None else "Not found",
+        "sampled_at": parser.latest_sampled_at,
+        "metrics": dict(parser.latest),
     }
     return jsonify(response)
 
-@app.route('/gpu_metrics_chart', methods=['GET'])
-def gpu_metrics_chart():
-    # Get the historical data
-    historical_data = get_historical_data()
-    
-    if not historical_data:
-        return "No historical GPU HW Active Residency data found.", 404
+@app.route('/gpu_metrics/range', methods=['GET'])
+def gpu_metrics_range():
+    metric = request.args.get("metric")
+    if not metric:
+        return jsonify({"error": "metric is required", "metrics": store.metrics()}), 400
+    try:
+        end = float(request.args.get("to", time.time()))
+        start = float(request.args.get("from", end - 3600))
+        step = request.args.get("step", type=float)
+        if end <= start or (step is not None and step <= 0):
+            raise ValueError("Expected from < to and step > 0.")
+        step, points = store.query(metric, start, end, step)
+    except KeyError:
+        return jsonify({"error": f"Unknown metric '{metric}'", "metrics": store.metrics()}), 404
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"metric": metric, "from": start, "to": end, "step": step, "points": points})
+
+def chart_data():
+    # Average residency of the last MAX_OBSERVATIONS 10 s buckets
+    now = time.time()
+    try:
+        _, points = store.query("gpu_hw_active_residency", now - 10 * MAX_OBSERVATIONS, now, 10)
+    except KeyError:
+        points = []
+    return [point["avg"] for point in points]
 
-    # Create a bar chart using historical data
-    plt.figure(figsize=(12, 6))
-    plt.box(False)
-    plt.axis('off')
+def render_chart_png(historical_data, width, height):
+    # A Figure of its own (no pyplot state machine), so concurrent renders can't draw into each other's plots
+    figure = Figure(figsize=(width / CHART_DPI, height / CHART_DPI), dpi=CHART_DPI)
+    FigureCanvasAgg(figure)
+    axes = figure.subplots()
+    axes.set_frame_on(False)
+    axes.axis('off')
     indices = list(range(1, len(historical_data) + 1))
-    plt.bar(indices, historical_data, color='blue')
-    # plt.xlabel('Observation Number')
-    # plt.ylabel('GPU HW Active Residency (%)')
-    # plt.title('Historical GPU HW Active Residency (Last 20 Observations)')
-    plt.ylim(0, 100)
-    plt.xticks(indices)  # Add observation numbers as x-axis labels
-
-    # Save the plot to a bytes buffer and return it as an image response
+    axes.bar(indices, historical_data, color='blue')
+    axes.set_ylim(0, 100)
+    axes.set_xticks(indices)  # Add observation numbers as x-axis labels
+
     buf = io.BytesIO()
-    plt.savefig(buf, format='png')
-    buf.seek(0)
-    plt.close()
+    figure.savefig(buf, format='png')
+    return buf.getvalue()
+
+def render_chart_svg(historical_data, width, height):
+    # Plain bars on a 0-100 scale, built as text; no matplotlib involved
+    slot = width / len(historical_data)
+    bars = "".join(
+        f'<rect x="{(index + 0.1) * slot:.1f}" y="{height * (1 - min(value, 100) / 100):.1f}" '
+        f'width="{slot * 0.8:.1f}" height="{height * min(value, 100) / 100:.1f}" fill="blue"/>'
+        for index, value in enumerate(historical_data)
+    )
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+            f'viewBox="0 0 {width} {height}">{bars}</svg>').encode()
+
+CHART_FORMATS = {"png": (render_chart_png, "image/png"), "svg": (render_chart_svg, "image/svg+xml")}
+
+class ChartCache:
+    """
+    Rendered charts keyed on (store version, format, width, height). A chart is
+    only re-rendered after the sampler has added data. Renders happen one at a
+    time under the cache lock, so simultaneous requests for a missing chart
+    produce it only once.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (body, etag), or None when there was no data to plot
+        self._lock = threading.Lock()
+
+    def get(self, chart_format, width, height):
+        key = (store.version, chart_format, width, height)
+        with self._lock:
+            if key not in self._entries:
+                historical_data = chart_data()
+                body = CHART_FORMATS[chart_format][0](historical_data, width, height) if historical_data else None
+                self._entries[key] = (body, hashlib.sha1(body).hexdigest()) if body is not None else None
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+chart_cache = ChartCache(CHART_CACHE_ENTRIES)
+
+@app.route('/gpu_metrics_chart', methods=['GET'])
+def gpu_metrics_chart():
+    chart_format = request.args.get("format", "png")
+    width = request.args.get("width", CHART_DEFAULT_SIZE[0], type=int)
+    height = request.args.get("height", CHART_DEFAULT_SIZE[1], type=int)
+    if chart_format not in CHART_FORMATS:
+        return f"format must be one of: {', '.join(CHART_FORMATS)}", 400
+    if not (CHART_MIN_SIDE <= width <= CHART_MAX_SIDE and CHART_MIN_SIDE <= height <= CHART_MAX_SIDE):
+        return f"width and height must be between {CHART_MIN_SIDE} and {CHART_MAX_SIDE} pixels", 400
+
+    chart = chart_cache.get(chart_format, width, height)
+    if chart is None:
+        return "No historical GPU HW Active Residency data found.", 404
 
-    return Response(buf, mimetype='image/png')
+    body, etag = chart
+    response = Response(body, mimetype=CHART_FORMATS[chart_format][1])
+    response.set_etag(etag)
+    response.cache_control.no_cache = True  # Clients may keep it but must revalidate; unchanged charts answer 304
+    return response.make_conditional(request)
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -1,18 +1,36 @@
 import os
 import uuid
 import logging
-from typing import Optional, List, Dict, Any # 'Any' for the pipeline object type for now
-from dataclasses import dataclass
+import math
+import time
+import base64
+import functools
+import hashlib
+import json
+import re
+import sqlite3
+import sys
+import threading
+import dataclasses
+import contextlib
+import multiprocessing
+from multiprocessing import shared_memory
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional, List, Dict, Any, Deque, Callable, Tuple, Set # 'Any' for the pipeline object type for now
+from dataclasses import dataclass, field
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import asyncio
 import random
 
-import torch
-from fastapi import FastAPI, HTTPException, Query, Request, BackgroundTasks
-from fastapi.responses import JSONResponse, FileResponse
+import numpy as np
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
 from sse_starlette.sse import EventSourceResponse # For SSE
 from fastapi.middleware.cors import CORSMiddleware
-# Import pipeline from transformers, possibly with an alias
-from transformers import pipeline as hf_transformer_pipeline
+# torch and transformers are imported inside the functions that need them so the
+# server binds its port immediately and the model loads in the background.
 from pydantic import BaseModel, Field
 import soundfile as sf # For saving audio
 from contextlib import asynccontextmanager
@@ -32,10 +50,51 @@ logger = logging.getLogger("musicgen_pipeline_api")
 # --------------------------------------------------------------------------
 @dataclass
 class MusicGenConfig:
-    model_id: str = "facebook/musicgen-small"
-    output_dir: str = "./generated_music_pipeline"
+    model_id: str = "facebook/musicgen-small" # Default model: loaded at startup and used when a request names none
+    available_models: Dict[str, str] = field(default_factory=lambda: {
+        "musicgen-small": "facebook/musicgen-small",
+        "musicgen-medium": "facebook/musicgen-medium",
+        "musicgen-melody": "facebook/musicgen-melody",
+    }) # Request `model` name -> Hub id or local snapshot directory; other models load on first use
+    model_memory_budget_bytes: Optional[int] = None # Combined weights of resident models (VRAM on GPU, RAM on CPU); None = 80% of VRAM / 50% of RAM
+    model_snapshot_dir: Optional[str] = None # Pre-downloaded snapshot of the default model (e.g. baked into the image); skips the Hub lookup
+    model_local_files_only: bool = False # Resolve model_id from the local Hugging Face cache only, never the network
+    output_dir: str = "./generated_music_pipeline" # Tracks are stored in 256 hash-sharded subdirectories below this
+    output_max_bytes: Optional[int] = 20 * 1024 ** 3 # Disk quota for all stored tracks (incl. transcodes); least-recently-used go first; None = unlimited
+    output_max_age_seconds: Optional[int] = 30 * 24 * 3600 # Tracks not generated or downloaded for this long are deleted; None keeps them
+    output_sample_subtype: str = "PCM_16" # WAV sample format: "PCM_16" or "FLOAT" (32-bit, twice the size)
+    output_janitor_interval_seconds: int = 300 # How often age and quota limits are enforced in the background
     tokens_per_second_approx: int = 50
     max_generation_tokens_cap: int = 3000 # Approx 60 seconds
+    guidance_scale: float = 3.0
+    max_concurrent_generations: int = 1 # Size of the dedicated inference executor
+    inference_processes: int = 0 # >0 runs generation in this many model-holding worker processes instead of threads
+    torch_threads_per_process: Optional[int] = None # Defaults to cpu_count // inference_processes
+    inference_backend: str = "fp32" # "fp32" (eager), "int8" (dynamic-quantized linears, CPU only), "bf16" (autocast) or "compile" (torch.compile)
+    warmup_tokens: int = 20 # Tokens generated once after loading so the first request doesn't pay for kernel selection/compilation; 0 disables
+    max_pending_jobs: int = 16 # Requests beyond this are rejected with 429
+    default_retry_after_seconds: int = 30 # Used until a real job duration has been measured
+    max_batch_size: int = 4 # Jobs merged into one pipeline forward pass
+    batch_window_ms: int = 50 # How long the oldest job waits for batch partners
+    batch_token_bucket_size: int = 250 # Jobs whose max_new_tokens fall in the same bucket (~5 s) batch together
+    stream_chunk_tokens: int = 50 # Streaming mode: decode and emit audio every N tokens (~1 s)
+    stream_context_tokens: int = 50 # Streaming mode: extra frames re-decoded before each chunk to warm up the codec
+    text_encoder_cache_max_bytes: int = 64 * 1024 ** 2 # Encoded prompts kept for reuse; 0 lets the pipeline re-encode every prompt
+    result_cache_enabled: bool = True
+    result_cache_max_bytes: int = 2 * 1024 ** 3 # Cached tracks beyond this are evicted least-recently-used first
+    result_cache_max_age_seconds: int = 7 * 24 * 3600 # Cached tracks unused for this long are evicted
+    cache_unseeded_requests: bool = False # If True, identical prompts without a seed also share one track
+    long_form_segment_tokens: int = 1000 # Long-form: new tokens generated per window (~20 s)
+    long_form_context_tokens: int = 250 # Long-form: tail of the previous window fed back as audio prompt (~5 s)
+    long_form_crossfade_tokens: int = 50 # Long-form: overlap crossfaded between windows (~1 s)
+    eager_transcode_format: Optional[str] = None # "flac" or "ogg" to encode at generation time instead of on first download
+    task_ttl_seconds: int = 3600 # Finished tasks (and their event logs) are kept this long for reconnects
+    task_max_age_seconds: int = 6 * 3600 # Unfinished tasks older than this are considered stuck and reaped
+    task_store_max_tasks: int = 1000 # Oldest finished tasks are dropped early beyond this many
+    task_reap_interval_seconds: int = 60
+    task_store_sqlite_path: Optional[str] = None # e.g. "./tasks.db" to keep task status and events across restarts
+    abandoned_task_grace_seconds: Optional[int] = 30 # Cancel a task once all its SSE clients have been gone this long; None disables
+    profile_trace_dir: Optional[str] = None # Enables `profile` requests; torch profiler traces are written here as <task_id>.json
 
 config = MusicGenConfig()
 
@@ -44,10 +103,14 @@ config = MusicGenConfig()
 # --------------------------------------------------------------------------
 class GenerationRequest(BaseModel):
     prompt: str = Field(..., min_length=3, description="Text description of the music to generate.")
-    duration: Optional[float] = Field(30.0, gt=0, le=120, description="Desired duration in seconds (approximate, 1-120s).")
+    model: Optional[str] = Field(None, description="Model name from /music/models. Defaults to the server's default model.")
+    duration: Optional[float] = Field(30.0, gt=0, le=300, description="Desired duration in seconds (approximate, 1-300s). Tracks longer than the single-pass cap are generated in segments.")
     genre: Optional[str] = Field(None, description="Specific genre to target.")
     instruments: Optional[List[str]] = Field(None, description="Instruments to include.")
     tempo: Optional[int] = Field(None, gt=0, description="Tempo in BPM (e.g., 120).")
+    stream: bool = Field(False, description="Emit decoded audio as `chunk` SSE events while the track is still generating.")
+    seed: Optional[int] = Field(None, ge=0, le=2**32 - 1, description="Random seed (0 to 2**32 - 1) for reproducible generation. Seeded requests are served from the result cache when possible.")
+    profile: bool = Field(False, description="Record a torch profiler trace of this generation (ignored unless the server sets profile_trace_dir).")
 
 class InitialGenerationResponse(BaseModel):
     task_id: str
@@ -63,6 +126,13 @@ class SSEEventData(BaseModel):
     filename_suggestion: Optional[str] = None
     duration: Optional[float] = None
     track_id: Optional[str] = None
+    position: Optional[int] = None
+    segment_index: Optional[int] = None
+    segment_count: Optional[int] = None
+    chunk_index: Optional[int] = None
+    audio_chunk: Optional[str] = None # Base64-encoded audio for `chunk` events
+    audio_encoding: Optional[str] = None
+    sampling_rate: Optional[int] = None
 
 class SSEEvent(BaseModel):
     event: str
@@ -71,8 +141,6 @@ class SSEEvent(BaseModel):
 # --------------------------------------------------------------------------
 # Global Variables for Pipeline and SSE
 # --------------------------------------------------------------------------
-synthesiser_pipeline: Optional[Any] = None # Stores the Hugging Face pipeline object
-task_event_queues: Dict[str, asyncio.Queue] = {}
 
 # For Random Song Titles
 ADJECTIVES = ["Electric", "Cosmic", "Lost", "Forgotten", "Midnight", "Starlight", "Dreamy", "Retro", "Future", "Silent", "Whispering", "Golden", "Crystal", "Phantom", "Neon", "Velvet", "Mystic", "Galactic", "Lunar", "Solar", "Oceanic", "Crimson", "Emerald", "Sapphire", "Shadow", "Blazing", "Frozen", "Digital", "Analog"]
@@ -80,13 +148,203 @@ NOUNS_THEME = ["Journey", "Echoes", "Dreams", "Horizons", "Memories", "Secrets",
 NOUNS_ABSTRACT = ["Heartbeat", "Soul", "Mind", "Vision", "Reflection", "Illusion", "Destiny", "Mirage", "Vortex", "Frequency", "Signal", "Code", "Glitch", "Algorithm"]
 
 
+# --------------------------------------------------------------------------
+# Metrics (Prometheus text exposition served at /music/metrics)
+# --------------------------------------------------------------------------
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+class Metric:
+    """A labelled metric family. Thread-safe, since inference threads record into it too."""
+    metric_type = "untyped"
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...], extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(zip(self.labelnames, key)) + ([extra] if extra else [])
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{self._labels(key)} {value}" for key, value in self._values.items()]
+
+class Gauge(Metric):
+    """A gauge that is either set directly or read from `callback` at scrape time (None skips the sample)."""
+    metric_type = "gauge"
+
+    def __init__(self, name: str, help_text: str, callback: Optional[Callable[[], Optional[float]]] = None):
+        super().__init__(name, help_text)
+        self.callback = callback
+        self._value = 0.0
+
+    def set(self, value: float):
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.inc(-amount)
+
+    def _samples(self) -> List[str]:
+        value = self.callback() if self.callback is not None else self._value
+        return [] if value is None else [f"{self.name} {value}"]
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = buckets
+        self._series: Dict[Tuple[str, ...], List[float]] = {} # Per-bucket counts, then sum and count
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.setdefault(key, [0.0] * (len(self.buckets) + 2))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, series in self._series.items():
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{self._labels(key, ('le', str(bound)))} {count}")
+            lines.append(f"{self.name}_bucket{self._labels(key, ('le', '+Inf'))} {series[-1]}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {series[-2]}")
+            lines.append(f"{self.name}_count{self._labels(key)} {series[-1]}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+@contextlib.contextmanager
+def timed_stage(timings: Dict[str, float], stage: str):
+    """Adds the wall time of the enclosed block to `timings[stage]`."""
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started_at
+
+def model_parameter_bytes(pipe) -> int:
+    model = pipe.model
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+def cuda_memory_allocated_bytes() -> Optional[float]:
+    torch = sys.modules.get("torch") # Only report once something else has imported torch
+    if torch is None or not torch.cuda.is_available():
+        return None
+    return float(torch.cuda.memory_allocated())
+
+def process_resident_bytes() -> Optional[float]:
+    try:
+        with open("/proc/self/statm") as statm:
+            return float(int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE"))
+    except (OSError, ValueError):
+        return None
+
+metrics = MetricsRegistry()
+STAGE_SECONDS = metrics.register(Histogram(
+    "musicgen_stage_seconds",
+    "Wall time per hot-path stage: queue_wait and prompt_enhancement per request, sse_delivery per live event, the rest per batch.",
+    labelnames=("stage",),
+))
+TOKENS_PER_SECOND = metrics.register(Histogram(
+    "musicgen_tokens_per_second", "Audio tokens generated per second of forward pass, summed over the batch.",
+    buckets=(10, 25, 50, 100, 200, 400, 800, 1600, 3200),
+))
+REALTIME_FACTOR = metrics.register(Histogram(
+    "musicgen_realtime_factor", "Seconds of audio produced per wall second of forward pass, summed over the batch.",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0),
+))
+BATCH_SIZE = metrics.register(Histogram("musicgen_batch_size", "Jobs per pipeline forward pass.", buckets=(1, 2, 4, 8, 16)))
+REQUESTS_TOTAL = metrics.register(Counter(
+    "musicgen_requests_total", "Generate requests by outcome (queued, cached, rejected).", labelnames=("outcome",)
+))
+GENERATIONS_TOTAL = metrics.register(Counter("musicgen_generations_total", "Finished generations by status.", labelnames=("status",)))
+AUDIO_SECONDS_TOTAL = metrics.register(Counter("musicgen_generated_audio_seconds_total", "Seconds of audio generated."))
+SSE_CONNECTIONS = metrics.register(Gauge("musicgen_sse_connections", "Open SSE streams."))
+metrics.register(Gauge("musicgen_queue_depth", "Jobs waiting for an inference worker.", callback=lambda: scheduler.pending_count))
+metrics.register(Gauge("musicgen_active_generations", "Jobs currently being rendered.", callback=lambda: scheduler.active_jobs))
+metrics.register(Gauge("musicgen_pipeline_ready", "1 once the model is loaded and warmed up and track storage is indexed.", callback=lambda: float(pipeline_ready())))
+metrics.register(Gauge(
+    "musicgen_model_parameter_bytes", "Parameter and buffer bytes of the models resident in this process.",
+    callback=lambda: float(model_registry.resident_bytes()),
+))
+metrics.register(Gauge("musicgen_cuda_memory_allocated_bytes", "torch.cuda.memory_allocated().", callback=cuda_memory_allocated_bytes))
+metrics.register(Gauge("process_resident_memory_bytes", "Resident set size of this process.", callback=process_resident_bytes))
+metrics.register(Gauge("musicgen_output_bytes", "Bytes of stored tracks, transcodes included.", callback=lambda: float(track_storage.total_bytes)))
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup code
     print("App is starting")
+    os.makedirs(config.output_dir, exist_ok=True)
+    storage_loader = asyncio.create_task(asyncio.to_thread(load_output_storage))
+    task_store.open()
+    reaper = asyncio.create_task(task_store.reap_forever(config.task_reap_interval_seconds))
+    janitor = asyncio.create_task(track_storage.janitor_forever(config.output_janitor_interval_seconds))
+    if inference_pool is not None:
+        inference_pool.start(asyncio.get_running_loop())
+        model_loader = asyncio.create_task(inference_pool.warm_up())
+    else:
+        # Load in the background so /music/live answers while weights are still loading
+        model_loader = asyncio.create_task(asyncio.to_thread(initialize_hf_pipeline))
+    scheduler.start()
     yield
     # Shutdown code
     print("App is shutting down")
+    await scheduler.stop()
+    model_loader.cancel()
+    storage_loader.cancel()
+    if inference_pool is not None:
+        inference_pool.stop()
+    reaper.cancel()
+    janitor.cancel()
+    task_store.close()
 
 # --------------------------------------------------------------------------
 # FastAPI Application Initialization
@@ -104,40 +362,274 @@ app = FastAPI(
 cors_options = {
     "allow_origins": ["*"], # Be more specific in production
     "allow_credentials": True,
-    "allow_methods": ["GET", "POST", "OPTIONS"],
-    "allow_headers": ["Content-Type", "Authorization"],
+    "allow_methods": ["GET", "POST", "DELETE", "OPTIONS"],
+    "allow_headers": ["Content-Type", "Authorization", "Range", "If-None-Match", "If-Range"],
+    "expose_headers": ["Content-Range", "Accept-Ranges", "ETag", "Content-Length"],
 }
 app.add_middleware(CORSMiddleware, **cors_options)
 
 # --------------------------------------------------------------------------
 # Pipeline Initialization
 # --------------------------------------------------------------------------
-def initialize_hf_pipeline():
-    global synthesiser_pipeline
-    if synthesiser_pipeline is not None:
-        logger.info("Hugging Face pipeline already initialized.")
-        return True
+INFERENCE_BACKENDS = ("fp32", "int8", "bf16", "compile")
+
+def apply_inference_backend(pipe, backend: str):
+    """Adapts a freshly loaded pipeline's model to the configured inference backend."""
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unknown inference_backend '{backend}'. Expected one of {INFERENCE_BACKENDS}.")
+    import torch
+
+    model = pipe.model
+    if backend == "int8":
+        if model.device.type != "cpu":
+            logger.warning("int8 dynamic quantization is CPU-only; keeping fp32 weights on GPU.")
+            return
+        torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        logger.info("Applied dynamic int8 quantization to linear layers.")
+    elif backend == "compile":
+        # Compile only the decoder step that runs once per token; sequence length varies, hence dynamic shapes
+        model.decoder.forward = torch.compile(model.decoder.forward, dynamic=True)
+        logger.info("Wrapped the MusicGen decoder with torch.compile.")
+
+def inference_autocast():
+    """Context manager active around every generation call; enables bf16 autocast for that backend."""
+    if config.inference_backend == "bf16":
+        import torch
+        device_type = "cuda" if torch.cuda.is_available() else "cpu"
+        return torch.autocast(device_type=device_type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+def warm_up_pipeline(pipe):
+    if config.warmup_tokens <= 0:
+        return
+    started_at = time.monotonic()
+    with inference_autocast():
+        pipe("warm up", forward_params={"max_new_tokens": config.warmup_tokens, "do_sample": True, "guidance_scale": config.guidance_scale})
+    logger.info(f"Pipeline warm-up ({config.warmup_tokens} tokens, backend {config.inference_backend}) took {time.monotonic() - started_at:.2f}s.")
+
+MODEL_SNAPSHOT_PATTERNS = ["*.json", "*.safetensors", "*.model", "*.txt"] # Config, weights and tokenizer files only
 
+def resolve_model_snapshot(model_id: str) -> str:
+    """
+    Returns a local directory holding the model's safetensors snapshot. A configured
+    snapshot directory (default model only) or a local path is used as is; otherwise the
+    snapshot is fetched into (or, with model_local_files_only, looked up in) the Hugging Face cache.
+    """
+    if config.model_snapshot_dir and model_id == config.model_id:
+        return config.model_snapshot_dir
+    if os.path.isdir(model_id):
+        return model_id
+    from huggingface_hub import snapshot_download
+
+    return snapshot_download(model_id, allow_patterns=MODEL_SNAPSHOT_PATTERNS, local_files_only=config.model_local_files_only)
+
+def load_pipeline(snapshot_dir: str):
+    """Builds a text-to-audio pipeline from a local snapshot, applies the inference backend and warms it up."""
+    import torch
+    from transformers import pipeline as hf_transformer_pipeline
+
+    device_id = 0 if torch.cuda.is_available() else -1
+    effective_device = "cuda:0" if device_id == 0 else "cpu"
+    logger.info(f"Loading pipeline from '{snapshot_dir}' on device: {effective_device} (device_id for pipeline: {device_id})")
+    # safetensors weights are memory-mapped rather than unpickled
+    pipe = hf_transformer_pipeline(
+        "text-to-audio",
+        model=snapshot_dir,
+        device=device_id,
+        model_kwargs={"use_safetensors": True},
+    )
+    apply_inference_backend(pipe, config.inference_backend)
+    warm_up_pipeline(pipe)
+    return pipe
+
+def default_model_budget_bytes() -> int:
+    import torch
+
+    if torch.cuda.is_available():
+        return int(torch.cuda.get_device_properties(0).total_memory * 0.8)
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2
+
+class ModelRegistry:
+    """
+    Text-to-audio pipelines by model id, loaded on first use and kept resident while
+    their combined weights fit the memory budget. Making room for a new model evicts
+    the least-recently-used models that no batch is currently rendering with.
+    Loads run one at a time on inference threads; lookups are thread-safe.
+    """
+    def __init__(self, budget_bytes: Optional[int]):
+        self.budget_bytes = budget_bytes
+        self.on_change: Optional[Callable[[], None]] = None # Pool workers report their state to the front process
+        self._pipelines: "OrderedDict[str, Any]" = OrderedDict() # model_id -> pipeline, least recently used first
+        self._sizes: Dict[str, int] = {}
+        self._in_use: Dict[str, int] = {}
+        self._states: Dict[str, str] = {} # loading, loaded, failed or evicted
+        self._errors: Dict[str, str] = {}
+        self._last_used: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def is_loaded(self, model_id: str) -> bool:
+        return model_id in self._pipelines
+
+    def error(self, model_id: str) -> Optional[str]:
+        return self._errors.get(model_id)
+
+    def resident_bytes(self) -> int:
+        with self._lock:
+            return sum(self._sizes[model_id] for model_id in self._pipelines)
+
+    def add(self, model_id: str, pipe, size_bytes: int = 0):
+        """Registers an already-built pipeline (e.g. a stand-in for benchmarks)."""
+        with self._lock:
+            self._pipelines[model_id] = pipe
+            self._sizes[model_id] = size_bytes
+            self._states[model_id] = "loaded"
+            self._last_used[model_id] = time.time()
+        self._changed()
+
+    def get(self, model_id: str):
+        """Returns the model's pipeline, loading it (and evicting others) first if needed. Blocking."""
+        with self._lock:
+            pipe = self._pipelines.get(model_id)
+            if pipe is not None:
+                self._pipelines.move_to_end(model_id)
+                self._last_used[model_id] = time.time()
+                return pipe
+        return self._load(model_id)
+
+    @contextlib.contextmanager
+    def use(self, model_id: str):
+        """Holds the model resident for the duration of a generation."""
+        while True:
+            # Lookup and pin under one lock, so no concurrent load can evict the model in between
+            with self._lock:
+                pipe = self._pipelines.get(model_id)
+                if pipe is not None:
+                    self._pipelines.move_to_end(model_id)
+                    self._in_use[model_id] = self._in_use.get(model_id, 0) + 1
+                    break
+            self._load(model_id) # Evicted again before we could pin it: retry
+        try:
+            yield pipe
+        finally:
+            with self._lock:
+                self._in_use[model_id] -= 1
+                self._last_used[model_id] = time.time()
+
+    def _load(self, model_id: str):
+        with self._load_lock:
+            if model_id in self._pipelines:
+                return self.get(model_id)
+            self._states[model_id] = "loading"
+            self._errors.pop(model_id, None)
+            self._changed()
+            started_at = time.monotonic()
+            logger.info(f"Loading model {model_id}...")
+            try:
+                if self.budget_bytes is None:
+                    self.budget_bytes = default_model_budget_bytes()
+                snapshot_dir = resolve_model_snapshot(model_id)
+                weights = [name for name in os.listdir(snapshot_dir) if name.endswith(".safetensors")]
+                estimated_bytes = sum(os.path.getsize(os.path.join(snapshot_dir, name)) for name in weights)
+                self._make_room(estimated_bytes, model_id)
+                pipe = load_pipeline(snapshot_dir)
+            except Exception as e:
+                self._states[model_id] = "failed"
+                self._errors[model_id] = str(e)
+                self._changed()
+                raise
+            size_bytes = model_parameter_bytes(pipe)
+            with self._lock:
+                self._pipelines[model_id] = pipe
+                self._sizes[model_id] = size_bytes
+                self._states[model_id] = "loaded"
+                self._last_used[model_id] = time.time()
+            logger.info(f"Model {model_id} loaded in {time.monotonic() - started_at:.2f}s ({size_bytes / 1024 ** 2:.0f} MB, backend {config.inference_backend}).")
+            try:
+                # The file-size estimate can be off (tied weights, dtype changes); settle up with the measured size
+                self._make_room(0, model_id)
+            except RuntimeError as e:
+                logger.warning(f"Model memory budget exceeded after loading {model_id}: {e}")
+            self._changed()
+            return pipe
+
+    def _make_room(self, needed_bytes: int, loading_model_id: str):
+        while self.resident_bytes() + needed_bytes > self.budget_bytes:
+            with self._lock:
+                # Pick and unregister the victim under one lock, so use() can't pin it in between
+                idle = [
+                    model_id for model_id in self._pipelines
+                    if model_id != loading_model_id and not self._in_use.get(model_id)
+                ]
+                if idle:
+                    self._pipelines.pop(idle[0])
+                    self._states[idle[0]] = "evicted"
+            if not idle:
+                raise RuntimeError(
+                    f"Not enough model memory budget to load {loading_model_id} "
+                    f"({needed_bytes / 1024 ** 2:.0f} MB needed, {self.resident_bytes() / 1024 ** 2:.0f} MB resident and in use)."
+                )
+            self._release_evicted(idle[0])
+
+    def _release_evicted(self, model_id: str):
+        """Frees what an evicted (already unregistered) model still holds."""
+        import gc
+
+        text_conditioning_cache.discard_model(model_id)
+        gc.collect()
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        logger.info(f"Evicted model {model_id} ({self._sizes.get(model_id, 0) / 1024 ** 2:.0f} MB).")
+        self._changed()
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "budget_bytes": self.budget_bytes,
+                "resident_bytes": sum(self._sizes[model_id] for model_id in self._pipelines),
+                "models": {
+                    model_id: {
+                        "state": state,
+                        "memory_bytes": self._sizes.get(model_id) if state == "loaded" else None,
+                        "in_use": self._in_use.get(model_id, 0),
+                        "last_used": self._last_used.get(model_id),
+                        "error": self._errors.get(model_id),
+                    }
+                    for model_id, state in self._states.items()
+                },
+            }
+
+model_registry = ModelRegistry(config.model_memory_budget_bytes)
+default_model_initialized = False # Stays True if the default model is later evicted; it reloads on demand
+
+def initialize_hf_pipeline() -> bool:
+    """Loads and warms up the default model. Returns False if that failed."""
+    global default_model_initialized
     logger.info(f"Initializing Hugging Face text-to-audio pipeline with model: {config.model_id}")
     try:
-        device_id = 0 if torch.cuda.is_available() else -1
-        effective_device = "cuda:0" if device_id == 0 else "cpu"
-        logger.info(f"Loading pipeline on device: {effective_device} (device_id for pipeline: {device_id})")
-
-        synthesiser_pipeline = hf_transformer_pipeline(
-            "text-to-audio",
-            model=config.model_id,
-            device=device_id
-        )
-        logger.info("Hugging Face pipeline loaded.")
+        model_registry.get(config.model_id)
         os.makedirs(config.output_dir, exist_ok=True)
-        logger.info(f"MusicGen pipeline for {config.model_id} initialized successfully.")
+        default_model_initialized = True
         return True
     except Exception as e:
         logger.error(f"CRITICAL ERROR during Hugging Face pipeline initialization: {str(e)}", exc_info=True)
-        synthesiser_pipeline = None
         return False
 
+def resolve_requested_model(name: Optional[str]) -> str:
+    """Maps a request's `model` (a configured name or model id) to a model id. Raises ValueError if unknown."""
+    if name is None:
+        return config.model_id
+    if name in config.available_models:
+        return config.available_models[name]
+    if name == config.model_id or name in config.available_models.values():
+        return name
+    raise ValueError(f"Unknown model '{name}'. Available: {', '.join(config.available_models)}.")
+
 # --------------------------------------------------------------------------
 # Helper Functions
 # --------------------------------------------------------------------------
@@ -157,178 +649,1751 @@ def sanitize_filename(name: str, default_name="track") -> str:
     sanitized = "".join(c for c in name if c.isalnum() or c in [' ', '_', '-']).strip().replace(' ', '_')
     return sanitized if sanitized else default_name
 
+def build_enhanced_prompt(prompt: str, genre: Optional[str], instruments: Optional[List[str]], tempo: Optional[int]) -> str:
+    enhanced_prompt = prompt
+    if genre: enhanced_prompt += f". Genre: {genre}."
+    if instruments: enhanced_prompt += f". Instruments: {', '.join(instruments)}."
+    if tempo: enhanced_prompt += f". Tempo: {tempo} BPM."
+    return enhanced_prompt
+
+# --------------------------------------------------------------------------
+# Track Storage (hash-sharded output_dir with quota, age and LRU eviction)
+# --------------------------------------------------------------------------
+class TrackStorage:
+    """
+    Owns every file below output_dir. A track is stored as
+    <output_dir>/<2 hex chars of sha1(track_id)>/<track_id>.wav, plus any
+    .flac/.ogg transcodes beside it, so no directory grows past
+    1/256 of the total. WAVs are written to a temp file and renamed into place,
+    so a download never sees a partial file. The index keeps tracks in
+    least-recently-used order (generation and downloads count as use). Recency
+    lives only in the index: files are never touched on a read, so a WAV's mtime
+    stays its generation time, which ETags and transcode freshness rely on. After
+    a restart tracks are ordered by generation time. evict() deletes tracks
+    unused for max_age_seconds, then the least recently used until the total is
+    back under max_bytes.
+    """
+    EXTENSIONS = ("wav", "flac", "ogg")
+    WRITE_BLOCK_FRAMES = 64 * 1024 # Converted to the sample format one block at a time
+    STALE_TEMP_SECONDS = 3600 # Temp files older than this are left over from a crash
+
+    def __init__(self, directory: str, max_bytes: Optional[int], max_age_seconds: Optional[int], sample_subtype: str):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.sample_subtype = sample_subtype
+        self.total_bytes = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, Tuple[int, float]]" = OrderedDict() # track_id -> (bytes, last used), least recent first
+        self._lock = threading.Lock()
+        self.on_remove: Optional[Callable[[str], None]] = None # Lets the result cache drop tracks evicted here
+
+    def path(self, track_id: str, extension: str = "wav") -> str:
+        shard = hashlib.sha1(track_id.encode("utf-8")).hexdigest()[:2]
+        return os.path.join(self.directory, shard, f"{track_id}.{extension}")
+
+    def _stat_track(self, track_id: str) -> Optional[Tuple[int, float]]:
+        """(bytes of all the track's files, mtime of its WAV, i.e. when it was generated), or None if the WAV is gone."""
+        try:
+            last_used = os.path.getmtime(self.path(track_id))
+        except FileNotFoundError:
+            return None
+        size = 0
+        for extension in self.EXTENSIONS:
+            try:
+                size += os.path.getsize(self.path(track_id, extension))
+            except FileNotFoundError:
+                pass
+        return size, last_used
+
+    def load(self):
+        """Rebuilds the index from disk. Flat files from before sharding are moved into their shard."""
+        track_ids = set()
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                stem, extension = os.path.splitext(entry.name)
+                if extension[1:] in self.EXTENSIONS:
+                    os.makedirs(os.path.dirname(self.path(stem)), exist_ok=True)
+                    os.replace(entry.path, self.path(stem, extension[1:]))
+                    track_ids.add(stem)
+            elif entry.is_dir() and len(entry.name) == 2:
+                for shard_entry in os.scandir(entry.path):
+                    if shard_entry.name.endswith(".tmp"):
+                        if now - shard_entry.stat().st_mtime > self.STALE_TEMP_SECONDS:
+                            os.remove(shard_entry.path)
+                    elif shard_entry.name.endswith(".wav"):
+                        track_ids.add(shard_entry.name[:-len(".wav")])
+        found = [(track_id, stat) for track_id in track_ids if (stat := self._stat_track(track_id)) is not None]
+        with self._lock:
+            self._entries.clear()
+            for track_id, stat in sorted(found, key=lambda item: item[1][1]):
+                self._entries[track_id] = stat
+            self.total_bytes = sum(size for size, _ in self._entries.values())
+        logger.info(f"Track storage loaded: {len(found)} tracks, {self.total_bytes / 1024 ** 2:.1f} MB.")
+        self.evict()
+
+    def write(self, track_id: str, audio_waveform_numpy: np.ndarray, sample_rate: int) -> str:
+        """Writes a mono WAV atomically in the configured sample format and returns its path."""
+        path = self.path(track_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with sf.SoundFile(tmp_path, "w", samplerate=sample_rate, channels=1, format="WAV", subtype=self.sample_subtype) as f:
+                for start in range(0, len(audio_waveform_numpy), self.WRITE_BLOCK_FRAMES):
+                    f.write(np.asarray(audio_waveform_numpy[start:start + self.WRITE_BLOCK_FRAMES], dtype=np.float32))
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.add(track_id)
+        return path
+
+    def add(self, track_id: str):
+        """(Re)indexes a track after its files changed, e.g. a new transcode, and enforces the quota."""
+        stat = self._stat_track(track_id)
+        with self._lock:
+            self.total_bytes -= self._entries.pop(track_id, (0, 0.0))[0]
+            if stat is not None:
+                self._entries[track_id] = (stat[0], time.time())
+                self.total_bytes += stat[0]
+        if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def lookup(self, track_id: str) -> Optional[str]:
+        """Path of the track's WAV, or None. Marks the track as used."""
+        path = self.path(track_id)
+        if not os.path.isfile(path):
+            self.remove(track_id)
+            return None
+        with self._lock:
+            if track_id not in self._entries:
+                return None
+            size, _ = self._entries.pop(track_id)
+            self._entries[track_id] = (size, time.time())
+        return path
+
+    def remove(self, track_id: str):
+        with self._lock:
+            self.total_bytes -= self._entries.pop(track_id, (0, 0.0))[0]
+        if self.on_remove is not None:
+            self.on_remove(track_id)
+        for extension in self.EXTENSIONS:
+            try:
+                os.remove(self.path(track_id, extension))
+            except FileNotFoundError:
+                pass
+
+    def evict(self) -> int:
+        """Applies the age limit and the quota. Returns the number of tracks deleted."""
+        victims = []
+        with self._lock:
+            cutoff = time.time() - self.max_age_seconds if self.max_age_seconds is not None else None
+            projected_bytes = self.total_bytes
+            for track_id, (size, last_used) in self._entries.items():
+                expired = cutoff is not None and last_used < cutoff
+                over_quota = self.max_bytes is not None and projected_bytes > self.max_bytes
+                if not expired and not over_quota:
+                    break # Entries are in LRU order, so the rest are newer and within quota
+                victims.append(track_id)
+                projected_bytes -= size
+        for track_id in victims:
+            self.remove(track_id)
+        if victims:
+            self.evictions += len(victims)
+            logger.info(f"Track storage evicted {len(victims)} tracks ({self.total_bytes / 1024 ** 2:.1f} MB now stored).")
+        return len(victims)
+
+    async def janitor_forever(self, interval_seconds: int):
+        while True:
+            await asyncio.sleep(interval_seconds)
+            try:
+                await asyncio.to_thread(self.evict)
+            except Exception as e:
+                logger.error(f"Track storage janitor failed: {e}", exc_info=True)
+
+    def track_ids(self) -> List[str]:
+        """Indexed tracks, least recently used first."""
+        with self._lock:
+            return list(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "tracks": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+        }
+
+track_storage = TrackStorage(config.output_dir, config.output_max_bytes, config.output_max_age_seconds, config.output_sample_subtype)
+
+# --------------------------------------------------------------------------
+# Result Cache (content-addressed tracks in track storage)
+# --------------------------------------------------------------------------
+class ResultCache:
+    """
+    Maps a hash of everything that determines a generation to a stored WAV.
+    Cached tracks live in track storage next to regular ones, named by a version-5
+    UUID derived from the hash, so they are downloadable through the normal
+    endpoint and can be told apart from per-task (version-4) tracks on restart.
+    On top of the storage-wide quota, cached tracks have their own age limit and
+    size budget, enforced least-recently-used first; a hit counts as a use.
+    The index is kept in LRU order with each entry's last use, so eviction only
+    looks at the entries it removes and never stats the rest.
+    """
+    def __init__(self, storage: TrackStorage, max_bytes: int, max_age_seconds: int):
+        self.storage = storage
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, Tuple[int, float]]" = OrderedDict() # track_id -> (size in bytes, last used), least recent first
+        self._total_bytes = 0
+        self._lock = threading.Lock() # Storage evictions arrive from the janitor thread
+        storage.on_remove = self.forget
+
+    @staticmethod
+    def track_id_for(model_id: str, enhanced_prompt: str, requested_tokens: int, guidance_scale: float, seed: Optional[int]) -> str:
+        key = json.dumps([model_id, enhanced_prompt, requested_tokens, guidance_scale, seed])
+        digest = hashlib.sha256(key.encode("utf-8")).digest()
+        return str(uuid.UUID(bytes=digest[:16], version=5))
+
+    def _path(self, track_id: str) -> str:
+        return self.storage.path(track_id)
+
+    def load(self):
+        """Rebuilds the index from the cached tracks in storage (call after track_storage.load())."""
+        found = []
+        for track_id in self.storage.track_ids():
+            try:
+                if uuid.UUID(track_id).version != 5:
+                    continue
+            except ValueError:
+                continue
+            path = self._path(track_id)
+            try:
+                found.append((track_id, os.path.getsize(path), os.path.getmtime(path)))
+            except FileNotFoundError:
+                continue
+        with self._lock:
+            self._entries.clear()
+            for track_id, size, last_used in sorted(found, key=lambda item: item[2]):
+                self._entries[track_id] = (size, last_used)
+            self._total_bytes = sum(size for size, _ in self._entries.values())
+        logger.info(f"Result cache loaded: {len(found)} tracks, {self._total_bytes / 1024 ** 2:.1f} MB.")
+        self.evict()
+
+    def lookup(self, track_id: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(track_id)
+        if entry is not None:
+            path = self.storage.lookup(track_id) if time.time() - entry[1] <= self.max_age_seconds else None
+            if path is not None:
+                with self._lock:
+                    if track_id in self._entries:
+                        self._entries[track_id] = (self._entries.pop(track_id)[0], time.time())
+                self.hits += 1
+                return path
+            self._remove(track_id)
+        self.misses += 1
+        return None
+
+    def add(self, track_id: str):
+        path = self._path(track_id)
+        if not os.path.isfile(path):
+            return
+        size = os.path.getsize(path)
+        with self._lock:
+            self._total_bytes -= self._entries.pop(track_id, (0, 0.0))[0]
+            self._entries[track_id] = (size, time.time())
+            self._total_bytes += size
+        self.evict()
+
+    def forget(self, track_id: str) -> bool:
+        """Drops a track from the index without touching its files. Returns whether it was indexed."""
+        with self._lock:
+            entry = self._entries.pop(track_id, None)
+            if entry is not None:
+                self._total_bytes -= entry[0]
+        return entry is not None
+
+    def _remove(self, track_id: str):
+        if self.forget(track_id):
+            self.evictions += 1
+        self.storage.remove(track_id) # The WAV plus any transcoded copies
+
+    def evict(self):
+        """Removes least recently used entries while they are expired or the cache is over budget."""
+        cutoff = time.time() - self.max_age_seconds
+        while True:
+            with self._lock:
+                if not self._entries:
+                    return
+                oldest, (_, last_used) = next(iter(self._entries.items()))
+                over_budget = self._total_bytes > self.max_bytes
+                if not over_budget and last_used >= cutoff:
+                    return # Entries are in LRU order, so the rest are newer and within budget
+            if over_budget:
+                logger.info(f"Result cache over budget ({self._total_bytes} > {self.max_bytes} bytes). Evicting {oldest}.")
+            self._remove(oldest)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+result_cache = ResultCache(track_storage, config.result_cache_max_bytes, config.result_cache_max_age_seconds)
+
+output_storage_loaded = False # The node isn't ready until output_dir has been indexed
+output_storage_error: Optional[str] = None
+
+def load_output_storage():
+    """Indexes track storage and the result cache. Blocking; run off the event loop so a large output_dir doesn't delay startup."""
+    global output_storage_loaded, output_storage_error
+    try:
+        track_storage.load()
+        if config.result_cache_enabled:
+            result_cache.load()
+        output_storage_loaded = True
+    except Exception as e:
+        output_storage_error = str(e)
+        logger.error(f"Failed to load track storage from {config.output_dir}: {e}", exc_info=True)
+
+# --------------------------------------------------------------------------
+# Text Conditioning Cache (T5 encoder outputs reused across requests)
+# --------------------------------------------------------------------------
+class TextConditioningCache:
+    """
+    LRU cache of text-encoder hidden states keyed on the tokenized prompt and bounded
+    by tensor bytes. Entries are stored unpadded; a batch is assembled by right-padding
+    them with masked positions, which leaves T5's outputs for real tokens unchanged.
+    MusicGen's classifier-free guidance "null" condition is all-zero hidden states under
+    an all-zero mask, so the unconditional half is a zeros block rather than an encoder pass.
+    Thread-safe; each inference process holds its own cache.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Tuple[str, Tuple[int, ...]], Any]" = OrderedDict() # (model id, token ids) -> (seq_len, hidden) tensor
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def _get(self, key: Tuple[str, Tuple[int, ...]]):
+        with self._lock:
+            hidden = self._entries.get(key)
+            if hidden is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return hidden
+
+    def _put(self, key: Tuple[str, Tuple[int, ...]], hidden):
+        size = hidden.numel() * hidden.element_size()
+        with self._lock:
+            if key in self._entries or size > self.max_bytes:
+                return
+            self._entries[key] = hidden
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= evicted.numel() * evicted.element_size()
+
+    def discard_model(self, model_id: str):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == model_id]:
+                evicted = self._entries.pop(key)
+                self._total_bytes -= evicted.numel() * evicted.element_size()
+
+    def conditioning(self, model_id: str, pipe, prompts: List[str], guidance_scale: float) -> Dict[str, Any]:
+        """Returns `input_ids`, `attention_mask` and `encoder_outputs` for `model.generate`, encoding only unseen prompts."""
+        import torch
+        from transformers.modeling_outputs import BaseModelOutput
+
+        model, tokenizer = pipe.model, pipe.tokenizer
+        token_ids = [tuple(ids) for ids in tokenizer(prompts)["input_ids"]]
+        prompt_for = dict(zip(token_ids, prompts))
+        hidden_states = {ids: self._get((model_id, ids)) for ids in prompt_for}
+        missing = [ids for ids, hidden in hidden_states.items() if hidden is None]
+        if missing:
+            encoded = tokenizer([prompt_for[ids] for ids in missing], return_tensors="pt", padding=True).to(model.device)
+            with torch.no_grad():
+                last_hidden_state = model.text_encoder(**encoded).last_hidden_state
+            for row, ids in enumerate(missing):
+                hidden_states[ids] = last_hidden_state[row, :len(ids)].clone()
+                self._put((model_id, ids), hidden_states[ids])
+
+        max_length = max(len(ids) for ids in token_ids)
+        first = hidden_states[token_ids[0]]
+        hidden = torch.zeros((len(prompts), max_length, first.shape[-1]), dtype=first.dtype, device=model.device)
+        attention_mask = torch.zeros((len(prompts), max_length), dtype=torch.long, device=model.device)
+        input_ids = torch.full((len(prompts), max_length), tokenizer.pad_token_id, dtype=torch.long, device=model.device)
+        for row, ids in enumerate(token_ids):
+            hidden[row, :len(ids)] = hidden_states[ids]
+            attention_mask[row, :len(ids)] = 1
+            input_ids[row, :len(ids)] = torch.tensor(ids)
+        if guidance_scale is not None and guidance_scale > 1:
+            # generate() only adds the null condition itself when it runs the encoder
+            hidden = torch.cat([hidden, torch.zeros_like(hidden)], dim=0)
+            attention_mask = torch.cat([attention_mask, torch.zeros_like(attention_mask)], dim=0)
+        return {
+            "input_ids": input_ids, # Only sets the batch size; the encoder is skipped
+            "attention_mask": attention_mask,
+            "encoder_outputs": BaseModelOutput(last_hidden_state=hidden),
+        }
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._total_bytes, "hits": self.hits, "misses": self.misses}
+
+text_conditioning_cache = TextConditioningCache(config.text_encoder_cache_max_bytes)
+
+# --------------------------------------------------------------------------
+# Task Store (status, replayable event log and SSE fan-out per task)
+# --------------------------------------------------------------------------
+TERMINAL_EVENTS = {"complete", "error", "cancelled"}
+
+@dataclass
+class TaskRecord:
+    task_id: str
+    status: str = "queued"
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    events: List[Tuple[int, str, str]] = field(default_factory=list) # (event id, event name, SSEEvent JSON)
+    subscribers: Set[asyncio.Queue] = field(default_factory=set)
+    abandon_timer: Optional[asyncio.TimerHandle] = None # Pending auto-cancel since the last subscriber left
+
+    @property
+    def finished(self) -> bool:
+        return self.finished_at is not None
+
+class TaskStore:
+    """
+    Keeps every task's status and ordered event log so SSE clients can connect late,
+    reconnect with Last-Event-ID, or watch from several tabs at once. Each subscriber
+    gets its own queue. Finished tasks are reaped after a TTL. With a SQLite path the
+    log also survives restarts. `chunk` audio events are kept in memory only, and
+    only until the task finishes.
+    All methods must be called on the event loop thread.
+    """
+    def __init__(self, ttl_seconds: int, max_age_seconds: int, max_tasks: int, sqlite_path: Optional[str] = None):
+        self.ttl_seconds = ttl_seconds
+        self.max_age_seconds = max_age_seconds
+        self.max_tasks = max_tasks
+        self.sqlite_path = sqlite_path
+        self._tasks: "OrderedDict[str, TaskRecord]" = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+
+    def open(self):
+        if not self.sqlite_path:
+            return
+        self._db = sqlite3.connect(self.sqlite_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tasks (task_id TEXT PRIMARY KEY, status TEXT, created_at REAL, finished_at REAL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS task_events (task_id TEXT, event_id INTEGER, event TEXT, payload TEXT, "
+            "PRIMARY KEY (task_id, event_id))"
+        )
+        # Tasks that were still running when the previous process died will never finish
+        interrupted = [row[0] for row in self._db.execute("SELECT task_id FROM tasks WHERE finished_at IS NULL")]
+        for task_id in interrupted:
+            self.get(task_id)
+            self.publish(task_id, "error", SSEEventData(status="error", message="Generation interrupted by a server restart."))
+            self.finish(task_id)
+        self._db.commit()
+        logger.info(f"Task store opened at '{self.sqlite_path}' ({len(interrupted)} interrupted tasks closed).")
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def create(self, task_id: str) -> TaskRecord:
+        record = TaskRecord(task_id=task_id)
+        self._tasks[task_id] = record
+        if self._db is not None:
+            self._db.execute("INSERT INTO tasks VALUES (?, ?, ?, NULL)", (task_id, record.status, record.created_at))
+            self._db.commit()
+        if len(self._tasks) > self.max_tasks:
+            self._drop_oldest_finished(len(self._tasks) - self.max_tasks)
+        return record
+
+    def get(self, task_id: str) -> Optional[TaskRecord]:
+        record = self._tasks.get(task_id)
+        if record is None and self._db is not None:
+            record = self._load(task_id)
+        return record
+
+    def _load(self, task_id: str) -> Optional[TaskRecord]:
+        row = self._db.execute("SELECT status, created_at, finished_at FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        if row is None:
+            return None
+        record = TaskRecord(task_id=task_id, status=row[0], created_at=row[1], finished_at=row[2])
+        record.events = list(self._db.execute(
+            "SELECT event_id, event, payload FROM task_events WHERE task_id = ? ORDER BY event_id", (task_id,)
+        ))
+        self._tasks[task_id] = record
+        return record
+
+    def publish(self, task_id: str, event: str, data: SSEEventData) -> bool:
+        """Appends an event to the task's log and fans it out. Returns False for unknown or finished tasks."""
+        record = self._tasks.get(task_id)
+        if record is None or record.finished:
+            return False
+        event_id = record.events[-1][0] + 1 if record.events else 1
+        payload = SSEEvent(event=event, data=data).model_dump_json()
+        record.events.append((event_id, event, payload))
+        record.status = data.status
+        published_at = time.perf_counter()
+        for queue in record.subscribers:
+            queue.put_nowait((event_id, payload, published_at))
+        if self._db is not None and event != "chunk":
+            self._db.execute("INSERT INTO task_events VALUES (?, ?, ?, ?)", (task_id, event_id, event, payload))
+            self._db.execute("UPDATE tasks SET status = ? WHERE task_id = ?", (record.status, task_id))
+            self._db.commit()
+        return True
+
+    def finish(self, task_id: str):
+        """Marks the end of the task's event stream and releases its subscribers."""
+        record = self._tasks.get(task_id)
+        if record is None or record.finished:
+            return
+        record.finished_at = time.time()
+        # Streamed audio is only useful live; the finished WAV is downloadable, so late clients replay without it
+        record.events = [entry for entry in record.events if entry[1] != "chunk"]
+        if record.abandon_timer is not None:
+            record.abandon_timer.cancel()
+            record.abandon_timer = None
+        for queue in record.subscribers:
+            queue.put_nowait(None)
+        if self._db is not None:
+            self._db.execute("UPDATE tasks SET finished_at = ? WHERE task_id = ?", (record.finished_at, task_id))
+            self._db.commit()
+
+    def subscribe(self, task_id: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue()
+        record = self._tasks[task_id]
+        record.subscribers.add(queue)
+        if record.abandon_timer is not None: # A client came back within the grace period
+            record.abandon_timer.cancel()
+            record.abandon_timer = None
+        return queue
+
+    def unsubscribe(self, task_id: str, queue: asyncio.Queue):
+        record = self._tasks.get(task_id)
+        if record is not None:
+            record.subscribers.discard(queue)
+
+    def discard(self, task_id: str):
+        self._tasks.pop(task_id, None)
+        if self._db is not None:
+            self._db.execute("DELETE FROM task_events WHERE task_id = ?", (task_id,))
+            self._db.execute("DELETE FROM tasks WHERE task_id = ?", (task_id,))
+            self._db.commit()
+
+    def _drop_oldest_finished(self, count: int):
+        for task_id in [tid for tid, record in self._tasks.items() if record.finished and not record.subscribers][:count]:
+            self.discard(task_id)
+
+    def reap(self) -> int:
+        now = time.time()
+        expired = [
+            task_id for task_id, record in self._tasks.items()
+            if not record.subscribers and (
+                (record.finished and now - record.finished_at > self.ttl_seconds)
+                or (not record.finished and now - record.created_at > self.max_age_seconds)
+            )
+        ]
+        for task_id in expired:
+            self.discard(task_id)
+        if self._db is not None:
+            # Tasks loaded lazily after a restart may never be touched again
+            cutoff = now - self.ttl_seconds
+            self._db.execute("DELETE FROM task_events WHERE task_id IN (SELECT task_id FROM tasks WHERE finished_at < ?)", (cutoff,))
+            self._db.execute("DELETE FROM tasks WHERE finished_at < ?", (cutoff,))
+            self._db.commit()
+        return len(expired)
+
+    async def reap_forever(self, interval_seconds: int):
+        while True:
+            await asyncio.sleep(interval_seconds)
+            reaped = self.reap()
+            if reaped:
+                logger.info(f"Reaped {reaped} expired tasks ({len(self._tasks)} still tracked).")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "tracked": len(self._tasks),
+            "finished": sum(1 for record in self._tasks.values() if record.finished),
+            "subscribers": sum(len(record.subscribers) for record in self._tasks.values()),
+        }
+
+task_store = TaskStore(
+    ttl_seconds=config.task_ttl_seconds,
+    max_age_seconds=config.task_max_age_seconds,
+    max_tasks=config.task_store_max_tasks,
+    sqlite_path=config.task_store_sqlite_path,
+)
+
 # --------------------------------------------------------------------------
 # Background Music Generation Task (Using Hugging Face Pipeline)
 # --------------------------------------------------------------------------
-async def perform_music_generation_and_notify(
-    task_id: str,
-    prompt: str,
-    duration: float,
-    genre: Optional[str],
-    instruments: Optional[List[str]],
+@dataclass
+class GenerationJob:
+    task_id: str
+    prompt: str
+    duration: float
+    genre: Optional[str]
+    instruments: Optional[List[str]]
     tempo: Optional[int]
-):
-    event_queue = task_event_queues.get(task_id)
-    if not event_queue:
-        logger.error(f"SSE Queue not found for task_id {task_id} at generation start.")
-        return
+    enqueued_at: float = field(default_factory=time.monotonic)
+    model_id: str = ""
+    stream: bool = False
+    seed: Optional[int] = None
+    profile: bool = False
+    enhanced_prompt: str = ""
+    track_id: str = "" # Output file name; a content hash for cacheable jobs, the task_id otherwise
+    cacheable: bool = False
+    title: str = ""
+    chunk_sink: Optional[Callable[[np.ndarray, int], None]] = None
+    event_sink: Optional[Callable[[str, SSEEventData], None]] = None
+    cancel_event: Optional[Any] = None # threading.Event, or a manager Event proxy when generation runs in the process pool
 
-    if synthesiser_pipeline is None:
-        logger.error(f"[Task: {task_id}] Hugging Face pipeline not initialized. Aborting generation.")
-        err_data = SSEEventData(status="error", message="Server components not ready (pipeline). Please try again later.")
-        await event_queue.put(SSEEvent(event="error", data=err_data).model_dump_json())
-        await event_queue.put(None)
-        return
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event is not None and self.cancel_event.is_set()
 
-    try:
-        enhanced_prompt = prompt
-        if genre: enhanced_prompt += f". Genre: {genre}."
-        if instruments: enhanced_prompt += f". Instruments: {', '.join(instruments)}."
-        if tempo: enhanced_prompt += f". Tempo: {tempo} BPM."
-        logger.info(f"[Task: {task_id}] Enhanced prompt for pipeline: {enhanced_prompt}")
+    @property
+    def requested_tokens(self) -> int:
+        return int(self.duration * config.tokens_per_second_approx)
+
+    @property
+    def is_long_form(self) -> bool:
+        return self.requested_tokens > config.max_generation_tokens_cap
+
+    @property
+    def max_new_tokens(self) -> int:
+        return min(self.requested_tokens, config.max_generation_tokens_cap)
+
+    @property
+    def batchable(self) -> bool:
+        # Streaming decodes a single sequence, a seed fixes the RNG for the whole forward pass
+        # and long-form jobs run their own windowed generation loop; a profile trace covers one request
+        return not self.stream and self.seed is None and not self.is_long_form and not self.profile
+
+    @property
+    def token_bucket(self) -> int:
+        """Jobs in the same bucket generate a similar number of tokens and can share a forward pass."""
+        return math.ceil(self.max_new_tokens / config.batch_token_bucket_size)
+
+def publish_task_event(task_id: str, event: str, data: SSEEventData) -> bool:
+    """Records an SSE event for the task and delivers it to every connected client."""
+    return task_store.publish(task_id, event, data)
+
+def publish_task_event_threadsafe(loop: asyncio.AbstractEventLoop, task_id: str, event: str, data: SSEEventData):
+    """Publishes an SSE event from an inference thread."""
+    loop.call_soon_threadsafe(publish_task_event, task_id, event, data)
+
+def normalize_audio_shape(task_id: str, raw_audio_output):
+    """Reduces the pipeline's audio array to a 1D mono waveform."""
+    logger.info(f"[Task: {task_id}] Raw audio output shape from pipeline: {raw_audio_output.shape}")
+
+    if raw_audio_output.ndim == 3:
+        # Handles (1, 1, N) or (1, C, N) by taking the first batch and first channel
+        logger.info(f"[Task: {task_id}] Audio is 3D, selecting [0, 0, :] for mono.")
+        audio_waveform_numpy = raw_audio_output[0, 0, :] # Assumes we want first channel if stereo
+    elif raw_audio_output.ndim == 2 and raw_audio_output.shape[0] == 1:
+        # Handles (1, N)
+        logger.info(f"[Task: {task_id}] Audio is 2D (1, N), squeezing to 1D.")
+        audio_waveform_numpy = raw_audio_output.squeeze()
+    elif raw_audio_output.ndim == 1:
+        # Handles (N,) - already correct
+        logger.info(f"[Task: {task_id}] Audio is already 1D.")
+        audio_waveform_numpy = raw_audio_output
+    else:
+        err_msg = f"Unexpected audio output shape from pipeline: {raw_audio_output.shape}. Cannot process for saving."
+        logger.error(f"[Task: {task_id}] {err_msg}")
+        raise ValueError(err_msg)
+
+    logger.info(f"[Task: {task_id}] Processed audio_waveform_numpy shape for saving: {audio_waveform_numpy.shape}")
+    return audio_waveform_numpy
+
+def publish_audio_chunk(event_sink: Callable[[str, SSEEventData], None], chunk_counter: List[int], audio: np.ndarray, sampling_rate: int):
+    pcm16 = (np.clip(audio, -1.0, 1.0) * 32767).astype("<i2")
+    chunk_data = SSEEventData(
+        status="streaming",
+        chunk_index=chunk_counter[0],
+        audio_chunk=base64.b64encode(pcm16.tobytes()).decode("ascii"),
+        audio_encoding="pcm_s16le",
+        sampling_rate=sampling_rate,
+        duration=len(pcm16) / sampling_rate,
+    )
+    chunk_counter[0] += 1
+    event_sink("chunk", chunk_data)
+
+class GenerationCancelled(Exception):
+    """Raised on the inference side when every job in a batch was cancelled mid-generation."""
+
+class CancellationCriteria:
+    """
+    transformers stopping criterion polled once per token step. Aborts the forward pass
+    by raising GenerationCancelled once every job in the batch has been cancelled; a batch
+    with a surviving job runs on. Raising rather than returning True skips MusicGen's
+    decode, which expects the codebook delay pattern to have been generated in full.
+    """
+    def __init__(self, jobs: List["GenerationJob"]):
+        self.jobs = jobs
+
+    def __call__(self, input_ids, scores, **kwargs):
+        import torch
+
+        if all(job.cancelled for job in self.jobs):
+            raise GenerationCancelled(f"Stopped at token step {input_ids.shape[-1]}.")
+        return torch.zeros((input_ids.shape[0],), dtype=torch.bool, device=input_ids.device)
+
+class AudioChunkStreamer:
+    """
+    Generation streamer (the transformers `put`/`end` streamer interface) that decodes MusicGen audio codes every `play_steps` tokens
+    and hands the newly finalized audio to `on_chunk(waveform, sampling_rate)`.
+    Only the last `play_steps + context_steps` frames are re-decoded per chunk so
+    decode cost stays constant over long tracks.
+    """
+    def __init__(self, model, on_chunk: Callable[[np.ndarray, int], None], play_steps: int, context_steps: int):
+        if model.decoder.config.audio_channels != 1:
+            raise ValueError("Audio streaming only supports mono MusicGen checkpoints.")
+        self.decoder = model.decoder
+        self.audio_encoder = model.audio_encoder
+        self.generation_config = model.generation_config
+        self.num_codebooks = model.decoder.num_codebooks
+        self.sampling_rate = model.config.audio_encoder.sampling_rate
+        self.hop_length = int(np.prod(self.audio_encoder.config.upsampling_ratios))
+        self.on_chunk = on_chunk
+        self.play_steps = play_steps
+        self.window_frames = play_steps + max(context_steps, play_steps)
+        # The codec's last few hundred samples change once later frames arrive, so hold them back.
+        self.stride = self.hop_length * max(play_steps - self.num_codebooks, 1) // 6
+        self.token_cache = None
+        self.steps_since_chunk = 0
+        self.emitted_samples = 0
+
+    def _decode_window(self):
+        import torch
 
-        prompt_keywords = [word for word in prompt.lower().split() if len(word) > 3]
-        generated_title = generate_random_song_title(prompt_keywords)
-        logger.info(f"[Task: {task_id}] Generated title: '{generated_title}'")
+        input_ids = self.token_cache
+        _, delay_pattern_mask = self.decoder.build_delay_pattern_mask(
+            input_ids[:, :1],
+            pad_token_id=self.generation_config.decoder_start_token_id,
+            max_length=input_ids.shape[-1],
+        )
+        input_ids = self.decoder.apply_delay_pattern_mask(input_ids, delay_pattern_mask)
+        audio_codes = input_ids[input_ids != self.generation_config.pad_token_id].reshape(1, self.num_codebooks, -1)
+        start_frame = max(0, audio_codes.shape[-1] - self.window_frames)
+        audio_codes = audio_codes[None, :, :, start_frame:].to(self.audio_encoder.device)
+        with torch.no_grad():
+            audio_values = self.audio_encoder.decode(audio_codes, audio_scales=[None]).audio_values
+        return audio_values[0, 0].cpu().float().numpy(), start_frame * self.hop_length
+
+    def _emit(self, final: bool):
+        if self.token_cache is None or self.token_cache.shape[-1] <= self.num_codebooks:
+            return
+        audio, window_offset = self._decode_window()
+        end = len(audio) if final else len(audio) - self.stride
+        chunk = audio[self.emitted_samples - window_offset:end]
+        if len(chunk) > 0:
+            self.emitted_samples += len(chunk)
+            self.on_chunk(chunk, self.sampling_rate)
+
+    def put(self, value):
+        import torch
+
+        if value.shape[0] // self.num_codebooks > 1:
+            raise ValueError("Audio streaming only supports batch size 1.")
+        if self.token_cache is None:
+            # First call carries the decoder start tokens
+            self.token_cache = value
+            return
+        self.token_cache = torch.cat([self.token_cache, value[:, None]], dim=-1)
+        self.steps_since_chunk += 1
+        if self.steps_since_chunk >= self.play_steps:
+            self.steps_since_chunk = 0
+            self._emit(final=False)
+
+    def end(self):
+        self._emit(final=True)
 
-        update_data = SSEEventData(status="processing", message=f"Crafting '{generated_title}' with pipeline...", title=generated_title)
-        await event_queue.put(SSEEvent(event="update", data=update_data).model_dump_json())
+def crossfade_join(audio: np.ndarray, continuation: np.ndarray, context_samples: int, crossfade_samples: int) -> np.ndarray:
+    """
+    Appends a continuation window whose first `context_samples` re-decode the tail of `audio`.
+    The last `crossfade_samples` of the existing audio are blended into the matching
+    part of the re-decoded tail, then the newly generated samples follow.
+    """
+    if crossfade_samples == 0:
+        return np.concatenate([audio, continuation[context_samples:]])
+    fade_in = np.linspace(0.0, 1.0, crossfade_samples, dtype=np.float32)
+    overlap = audio[-crossfade_samples:] * (1.0 - fade_in) + continuation[context_samples - crossfade_samples:context_samples] * fade_in
+    return np.concatenate([audio[:-crossfade_samples], overlap, continuation[context_samples:]])
 
-        max_tokens = int(duration * config.tokens_per_second_approx)
-        actual_max_tokens = min(max_tokens, config.max_generation_tokens_cap)
+def generate_long_form(pipe, job: GenerationJob) -> Tuple[np.ndarray, int]:
+    """
+    Generates tracks beyond max_generation_tokens_cap as a series of fixed-size windows.
+    Each window after the first is conditioned on the tail of the audio so far and joined
+    with a crossfade, so cost grows linearly with duration and peak memory stays flat.
+    """
+    import torch
 
+    model = pipe.model
+    if model.config.model_type != "musicgen":
+        # Melody checkpoints read input_values as a chroma condition, not as audio to continue
+        raise ValueError(f"Tracks longer than {config.max_generation_tokens_cap // config.tokens_per_second_approx}s need a non-melody MusicGen model.")
+    sampling_rate = model.config.audio_encoder.sampling_rate
+    hop_length = int(np.prod(model.audio_encoder.config.upsampling_ratios))
+    context_samples = config.long_form_context_tokens * hop_length
+    crossfade_samples = min(config.long_form_crossfade_tokens, config.long_form_context_tokens) * hop_length
+    total_samples = job.requested_tokens * hop_length
+    segment_count = math.ceil(job.requested_tokens / config.long_form_segment_tokens)
+
+    if uses_text_conditioning_cache(pipe):
+        text_inputs = text_conditioning_cache.conditioning(job.model_id, pipe, [job.enhanced_prompt], config.guidance_scale)
+    else:
+        text_inputs = pipe.tokenizer([job.enhanced_prompt], return_tensors="pt", padding=True).to(model.device)
+    audio = np.zeros(0, dtype=np.float32)
+    emitted_samples = 0
+    segment_index = 0
+    while len(audio) < total_samples:
+        remaining_tokens = math.ceil((total_samples - len(audio)) / hop_length)
+        # A few extra steps cover the codebook delay pattern so the last window isn't a sliver
+        new_tokens = min(config.long_form_segment_tokens, remaining_tokens + model.decoder.num_codebooks)
         generation_params = {
-            "max_new_tokens": actual_max_tokens,
+            "max_new_tokens": new_tokens,
             "do_sample": True,
-            "guidance_scale": 3.0,
+            "guidance_scale": config.guidance_scale,
+            "stopping_criteria": [CancellationCriteria([job])],
         }
-        logger.info(f"[Task: {task_id}] Pipeline generation_params: {generation_params}")
-
-        music_output_dict = synthesiser_pipeline(enhanced_prompt, forward_params=generation_params)
-        
-        # --- FIX FOR AUDIO SHAPE ---
-        raw_audio_output = music_output_dict["audio"]
-        logger.info(f"[Task: {task_id}] Raw audio output shape from pipeline: {raw_audio_output.shape}")
-
-        if raw_audio_output.ndim == 3:
-            # Handles (1, 1, N) or (1, C, N) by taking the first batch and first channel
-            logger.info(f"[Task: {task_id}] Audio is 3D, selecting [0, 0, :] for mono.")
-            audio_waveform_numpy = raw_audio_output[0, 0, :] # Assumes we want first channel if stereo
-        elif raw_audio_output.ndim == 2 and raw_audio_output.shape[0] == 1:
-            # Handles (1, N)
-            logger.info(f"[Task: {task_id}] Audio is 2D (1, N), squeezing to 1D.")
-            audio_waveform_numpy = raw_audio_output.squeeze()
-        elif raw_audio_output.ndim == 1:
-            # Handles (N,) - already correct
-            logger.info(f"[Task: {task_id}] Audio is already 1D.")
-            audio_waveform_numpy = raw_audio_output
+        if len(audio) == 0:
+            audio_values = model.generate(**text_inputs, **generation_params)
+            audio = audio_values[0, 0].cpu().float().numpy()
         else:
-            err_msg = f"Unexpected audio output shape from pipeline: {raw_audio_output.shape}. Cannot process for saving."
-            logger.error(f"[Task: {task_id}] {err_msg}")
-            raise ValueError(err_msg)
-        
-        logger.info(f"[Task: {task_id}] Processed audio_waveform_numpy shape for saving: {audio_waveform_numpy.shape}")
-        # --- END FIX FOR AUDIO SHAPE ---
-        
-        pipeline_sampling_rate = music_output_dict["sampling_rate"]
-        effective_sample_rate = pipeline_sampling_rate
-        
-        logger.info(f"[Task: {task_id}] Music generated with pipeline. Sampling rate: {effective_sample_rate} Hz.")
-
-        output_filename_base = sanitize_filename(generated_title)
-        server_filename = f"{task_id}.wav"
-        output_path = os.path.join(config.output_dir, server_filename)
-
-        sf.write(output_path, audio_waveform_numpy, effective_sample_rate)
-        actual_duration = len(audio_waveform_numpy) / effective_sample_rate
-        logger.info(f"[Task: {task_id}] Music saved to '{output_path}'. Actual duration: {actual_duration:.2f}s")
-
-        client_suggested_filename = f"{output_filename_base}_{task_id[:8]}.wav"
-
-        complete_data = SSEEventData(
-            status="completed",
-            message="Generation successful!",
-            track_id=task_id,
-            title=generated_title,
-            download_url=f"/music/download/{task_id}", # Note: Paths for client should be consistent
-            filename_suggestion=client_suggested_filename,
-            duration=actual_duration
+            audio_prompt = torch.from_numpy(audio[-context_samples:]).to(model.device, dtype=model.dtype)[None, None, :]
+            audio_values = model.generate(**text_inputs, input_values=audio_prompt, **generation_params)
+            continuation = audio_values[0, 0].cpu().float().numpy()
+            if len(continuation) <= context_samples:
+                raise RuntimeError(f"Long-form window {segment_index + 1} produced no new audio.")
+            audio = crossfade_join(audio, continuation, context_samples, crossfade_samples)
+        if job.cancelled:
+            raise GenerationCancelled(f"Task {job.task_id} cancelled after long-form segment {segment_index + 1}.")
+        segment_index += 1
+        segment_count = max(segment_count, segment_index)
+        logger.info(f"[Task: {job.task_id}] Long-form segment {segment_index}/{segment_count} done, {len(audio) / sampling_rate:.1f}s so far.")
+
+        if job.event_sink is not None:
+            job.event_sink("segment_complete", SSEEventData(
+                status="processing",
+                message=f"Segment {segment_index} of {segment_count} complete.",
+                segment_index=segment_index,
+                segment_count=segment_count,
+                duration=min(len(audio), total_samples) / sampling_rate,
+            ))
+        if job.chunk_sink is not None:
+            # Everything except the region the next window will crossfade over is final
+            final_samples = len(audio) if len(audio) >= total_samples else len(audio) - crossfade_samples
+            final_samples = min(final_samples, total_samples)
+            if final_samples > emitted_samples:
+                job.chunk_sink(audio[emitted_samples:final_samples], sampling_rate)
+                emitted_samples = final_samples
+
+    return audio[:total_samples], sampling_rate
+
+@contextlib.contextmanager
+def torch_profiler_trace(task_id: str):
+    """Records a torch profiler trace of the enclosed generation to profile_trace_dir/<task_id>.json."""
+    import torch
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    with torch.profiler.profile(activities=activities) as profiler:
+        yield
+    os.makedirs(config.profile_trace_dir, exist_ok=True)
+    trace_path = os.path.join(config.profile_trace_dir, f"{task_id}.json")
+    profiler.export_chrome_trace(trace_path)
+    logger.info(f"[Task: {task_id}] Torch profiler trace written to '{trace_path}'.")
+
+def uses_text_conditioning_cache(pipe) -> bool:
+    # Cached states are fed to cross-attention, which melody checkpoints don't use
+    return text_conditioning_cache.max_bytes > 0 and pipe.model.config.model_type == "musicgen"
+
+def generate_from_cached_conditioning(pipe, model_id: str, prompts: List[str], generation_params: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Same output as the pipeline call, but the prompts' encoder outputs come from the text conditioning cache."""
+    model = pipe.model
+    conditioning = text_conditioning_cache.conditioning(model_id, pipe, prompts, generation_params["guidance_scale"])
+    audio_values = model.generate(**conditioning, **generation_params)
+    sampling_rate = model.config.audio_encoder.sampling_rate
+    return [{"audio": audio.cpu().float().numpy(), "sampling_rate": sampling_rate} for audio in audio_values]
+
+def render_batch(jobs: List[GenerationJob], generation_params: Dict[str, Any], timings: Dict[str, float]) -> List[Tuple[np.ndarray, int]]:
+    """
+    Runs one pipeline forward pass for all jobs and returns a mono waveform and
+    sampling rate per job. Stage wall times are added to `timings`.
+    Blocking; must run on the inference executor.
+    """
+    profiling = config.profile_trace_dir is not None and len(jobs) == 1 and jobs[0].profile
+    profiler = torch_profiler_trace(jobs[0].task_id) if profiling else contextlib.nullcontext()
+    with model_registry.use(jobs[0].model_id) as pipe, profiler, inference_autocast():
+        if len(jobs) == 1 and jobs[0].seed is not None:
+            import torch
+            # Seeds the global RNG; reproducible as long as generations don't overlap (max_concurrent_generations == 1)
+            torch.manual_seed(jobs[0].seed)
+
+        if len(jobs) == 1 and jobs[0].is_long_form:
+            with timed_stage(timings, "forward"):
+                return [generate_long_form(pipe, jobs[0])]
+
+        if len(jobs) == 1 and jobs[0].chunk_sink is not None:
+            streamer = AudioChunkStreamer(
+                pipe.model,
+                on_chunk=jobs[0].chunk_sink,
+                play_steps=config.stream_chunk_tokens,
+                context_steps=config.stream_context_tokens,
+            )
+            generation_params = {**generation_params, "streamer": streamer}
+        generation_params = {**generation_params, "stopping_criteria": [CancellationCriteria(jobs)]}
+
+        with timed_stage(timings, "forward"):
+            if uses_text_conditioning_cache(pipe):
+                music_outputs = generate_from_cached_conditioning(pipe, jobs[0].model_id, [job.enhanced_prompt for job in jobs], generation_params)
+            elif len(jobs) == 1:
+                music_outputs = [pipe(jobs[0].enhanced_prompt, forward_params=generation_params)]
+            else:
+                music_outputs = pipe(
+                    [job.enhanced_prompt for job in jobs], forward_params=generation_params, batch_size=len(jobs)
+                )
+        if all(job.cancelled for job in jobs):
+            raise GenerationCancelled(f"All {len(jobs)} jobs in the batch were cancelled.")
+
+        rendered_tracks = []
+        batch_max_tokens = generation_params["max_new_tokens"]
+        for job, music_output_dict in zip(jobs, music_outputs):
+            with timed_stage(timings, "normalize"):
+                audio_waveform_numpy = normalize_audio_shape(job.task_id, music_output_dict["audio"])
+            if job.max_new_tokens < batch_max_tokens:
+                # The batch ran to its longest member; cut this track back to what was asked for.
+                keep_samples = round(len(audio_waveform_numpy) * job.max_new_tokens / batch_max_tokens)
+                audio_waveform_numpy = audio_waveform_numpy[:keep_samples]
+            rendered_tracks.append((audio_waveform_numpy, music_output_dict["sampling_rate"]))
+        return rendered_tracks
+
+def save_rendered_track(job: GenerationJob, audio_waveform_numpy: np.ndarray, pipeline_sampling_rate: int, timings: Dict[str, float]) -> float:
+    """Writes one rendered track to disk and returns its actual duration."""
+    task_id = job.task_id
+    effective_sample_rate = pipeline_sampling_rate
+
+    logger.info(f"[Task: {task_id}] Music generated with pipeline. Sampling rate: {effective_sample_rate} Hz.")
+
+    with timed_stage(timings, "write"):
+        output_path = track_storage.write(job.track_id, audio_waveform_numpy, effective_sample_rate)
+    actual_duration = len(audio_waveform_numpy) / effective_sample_rate
+    logger.info(f"[Task: {task_id}] Music saved to '{output_path}'. Actual duration: {actual_duration:.2f}s")
+    if config.eager_transcode_format:
+        with timed_stage(timings, "transcode"):
+            encoded_path = transcode_track(output_path, config.eager_transcode_format)
+            track_storage.add(job.track_id)
+        logger.info(f"[Task: {task_id}] Pre-encoded '{encoded_path}'.")
+    return actual_duration
+
+def synthesize_and_save_batch(jobs: List[GenerationJob], generation_params: Dict[str, Any], timings: Dict[str, float]) -> List[Optional[float]]:
+    """
+    Renders a batch in this process and writes one WAV per job. Returns the actual
+    duration of each track, or None for jobs cancelled while the batch was rendering.
+    """
+    rendered_tracks = render_batch(jobs, generation_params, timings)
+    return [
+        None if job.cancelled else save_rendered_track(job, waveform, sampling_rate, timings)
+        for job, (waveform, sampling_rate) in zip(jobs, rendered_tracks)
+    ]
+
+# --------------------------------------------------------------------------
+# Inference Process Pool (model-holding worker processes for CPU-only nodes)
+# --------------------------------------------------------------------------
+_worker_event_queue: Optional[Any] = None # Set inside pool worker processes only
+
+def _init_inference_worker(event_queue, torch_threads: int, parent_config: MusicGenConfig):
+    global _worker_event_queue
+    _worker_event_queue = event_queue
+    vars(config).update(vars(parent_config)) # Spawned workers re-import this module with default settings
+    model_registry.budget_bytes = config.model_memory_budget_bytes
+    text_conditioning_cache.max_bytes = config.text_encoder_cache_max_bytes
+    import torch
+    torch.set_num_threads(torch_threads)
+    logger.info(f"Inference worker {os.getpid()} loading pipeline with {torch_threads} torch threads.")
+    model_registry.on_change = lambda: event_queue.put((None, os.getpid(), model_registry.snapshot()))
+    initialize_hf_pipeline()
+
+def _publish_from_worker(task_id: str, event: str, data: SSEEventData):
+    _worker_event_queue.put((task_id, event, data))
+
+def _worker_ping() -> bool:
+    return default_model_initialized
+
+def _render_batch_in_worker(jobs: List[GenerationJob], generation_params: Dict[str, Any]) -> Tuple[List[Tuple[str, int, int]], Dict[str, float]]:
+    """
+    Pool-side entry point. Renders the batch and leaves each waveform in a shared
+    memory block instead of pickling it back. Returns (block name, samples, sampling rate)
+    per job plus the stage timings; the front process unlinks the blocks.
+    """
+    for job in jobs:
+        job.event_sink = functools.partial(_publish_from_worker, job.task_id)
+        if job.stream:
+            job.chunk_sink = functools.partial(publish_audio_chunk, job.event_sink, [0])
+    handles = []
+    timings: Dict[str, float] = {}
+    for waveform, sampling_rate in render_batch(jobs, generation_params, timings):
+        waveform = np.ascontiguousarray(waveform, dtype=np.float32)
+        block = shared_memory.SharedMemory(create=True, size=max(waveform.nbytes, 1))
+        np.ndarray(waveform.shape, dtype=np.float32, buffer=block.buf)[:] = waveform
+        handles.append((block.name, len(waveform), sampling_rate))
+        block.close()
+    return handles, timings
+
+class InferenceProcessPool:
+    """
+    N spawned worker processes, each holding its own pipeline with a fixed torch
+    thread count. SSE events raised inside a worker travel back on a multiprocessing
+    queue and are republished on the event loop by a relay thread. If a worker dies
+    (e.g. OOM-killed), the pool is not ready until a fresh set of workers has loaded.
+    """
+    def __init__(self, processes: int, torch_threads: int):
+        self.processes = processes
+        self.torch_threads = torch_threads
+        self.ready = False
+        self.load_failed = False
+        self.worker_models: Dict[int, Dict[str, Any]] = {} # Latest model registry snapshot per worker pid
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._events = None
+        self._relay: Optional[threading.Thread] = None
+        self._manager = None
+        self._context = multiprocessing.get_context("spawn")
+        self._restart_lock = threading.Lock()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=self._context,
+            initializer=_init_inference_worker,
+            initargs=(self._events, self.torch_threads, config),
         )
-        await event_queue.put(SSEEvent(event="complete", data=complete_data).model_dump_json())
 
+    def start(self, loop: asyncio.AbstractEventLoop):
+        self._events = self._context.Queue()
+        self._manager = self._context.Manager() # Hosts cancellation flags that worker processes poll
+        self._executor = self._new_executor()
+        self._relay = threading.Thread(target=self._relay_events, args=(loop,), name="inference-event-relay", daemon=True)
+        self._relay.start()
+        logger.info(f"Inference process pool started ({self.processes} processes x {self.torch_threads} torch threads).")
+
+    def new_cancel_event(self):
+        return self._manager.Event()
+
+    async def warm_up(self):
+        """Spawns every worker and waits for the pipelines to load."""
+        await asyncio.to_thread(self._warm_up_blocking)
+
+    def _warm_up_blocking(self):
+        pings = [self._executor.submit(_worker_ping) for _ in range(self.processes)]
+        results = []
+        for ping in pings:
+            try:
+                results.append(ping.result())
+            except Exception as e:
+                results.append(e)
+        self.ready = all(result is True for result in results)
+        self.load_failed = not self.ready
+        if self.ready:
+            logger.info("Inference process pool ready.")
+        else:
+            logger.error(f"Inference process pool failed to load the pipeline: {results}")
+
+    def _restart_after_crash(self, broken_executor: ProcessPoolExecutor):
+        """Replaces a pool whose worker died and reloads the pipelines. Blocking; concurrent callers wait for one restart."""
+        with self._restart_lock:
+            if self._executor is not broken_executor:
+                return # Another inference thread already restarted it
+            self.ready = False
+            logger.error("An inference worker process died; restarting the process pool.")
+            broken_executor.shutdown(wait=False, cancel_futures=True)
+            self.worker_models.clear()
+            self._executor = self._new_executor()
+            self._warm_up_blocking()
+
+    def stop(self):
+        self.ready = False
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self._events is not None:
+            self._events.put(None)
+            self._relay.join(timeout=5)
+            self._events = None
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+    def _relay_events(self, loop: asyncio.AbstractEventLoop):
+        while True:
+            item = self._events.get()
+            if item is None:
+                return
+            if item[0] is None:
+                _, pid, snapshot = item
+                self.worker_models[pid] = snapshot
+                continue
+            publish_task_event_threadsafe(loop, *item)
+
+    def synthesize_and_save_batch(self, jobs: List[GenerationJob], generation_params: Dict[str, Any], timings: Dict[str, float]) -> List[Optional[float]]:
+        """Blocking; renders on a worker process and writes the WAVs straight from shared memory."""
+        portable_jobs = [dataclasses.replace(job, event_sink=None, chunk_sink=None) for job in jobs]
+        executor = self._executor
+        try:
+            handles, worker_timings = executor.submit(_render_batch_in_worker, portable_jobs, generation_params).result()
+        except BrokenProcessPool:
+            # The batch may have been queued behind the crash rather than caused it: retry once on the new pool
+            self._restart_after_crash(executor)
+            if not self.ready:
+                raise
+            executor = self._executor
+            try:
+                handles, worker_timings = executor.submit(_render_batch_in_worker, portable_jobs, generation_params).result()
+            except BrokenProcessPool:
+                self._restart_after_crash(executor)
+                raise
+        timings.update(worker_timings)
+        blocks = [shared_memory.SharedMemory(name=name) for name, _, _ in handles]
+        try:
+            durations = []
+            for job, block, (_, length, sampling_rate) in zip(jobs, blocks, handles):
+                if job.cancelled:
+                    durations.append(None)
+                    continue
+                waveform = np.ndarray((length,), dtype=np.float32, buffer=block.buf)
+                durations.append(save_rendered_track(job, waveform, sampling_rate, timings))
+                del waveform
+            return durations
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+inference_pool: Optional[InferenceProcessPool] = None
+if config.inference_processes > 0:
+    inference_pool = InferenceProcessPool(
+        processes=config.inference_processes,
+        torch_threads=config.torch_threads_per_process or max(1, (os.cpu_count() or 1) // config.inference_processes),
+    )
+
+def new_cancel_event():
+    """A cancellation flag the inference side polls every token step; cross-process when the pool is in use."""
+    if inference_pool is not None:
+        return inference_pool.new_cancel_event()
+    return threading.Event()
+
+def model_resident(model_id: str) -> bool:
+    if inference_pool is not None:
+        return any(snapshot["models"].get(model_id, {}).get("state") == "loaded" for snapshot in inference_pool.worker_models.values())
+    return model_registry.is_loaded(model_id)
+
+def pipeline_ready() -> bool:
+    if not output_storage_loaded:
+        return False
+    if inference_pool is not None:
+        return inference_pool.ready
+    return default_model_initialized
+
+def record_batch_metrics(jobs: List[GenerationJob], generation_params: Dict[str, Any], timings: Dict[str, float], durations: List[Optional[float]]):
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, stage=stage)
+    BATCH_SIZE.observe(len(jobs))
+    saved_durations = [duration for duration in durations if duration is not None]
+    GENERATIONS_TOTAL.inc(len(saved_durations), status="completed")
+    AUDIO_SECONDS_TOTAL.inc(sum(saved_durations))
+    forward_seconds = timings.get("forward")
+    if forward_seconds:
+        # Every row of a batch runs to the batch's token budget; long-form jobs generate their full request
+        generated_tokens = sum(job.requested_tokens if job.is_long_form else generation_params["max_new_tokens"] for job in jobs)
+        TOKENS_PER_SECOND.observe(generated_tokens / forward_seconds)
+        REALTIME_FACTOR.observe(sum(saved_durations) / forward_seconds)
+    logger.info(f"[Batch: {', '.join(job.task_id for job in jobs)}] Stage timings: " + ", ".join(f"{stage}={seconds:.3f}s" for stage, seconds in timings.items()))
+
+async def perform_music_generation_and_notify(jobs: List[GenerationJob], executor: ThreadPoolExecutor):
+    live_jobs = []
+    for job in jobs:
+        record = task_store.get(job.task_id)
+        if record is not None and not record.finished:
+            live_jobs.append(job)
+        else:
+            logger.warning(f"[Task: {job.task_id}] Task cancelled or no longer tracked before generation started. Skipping.")
+    if not live_jobs:
+        return
+
+    if not pipeline_ready():
+        for job in live_jobs:
+            logger.error(f"[Task: {job.task_id}] Hugging Face pipeline not initialized. Aborting generation.")
+            err_data = SSEEventData(status="error", message="Server components not ready (pipeline). Please try again later.")
+            publish_task_event(job.task_id, "error", err_data)
+            task_store.finish(job.task_id)
+        return
+
+    try:
+        for job in live_jobs:
+            task_id = job.task_id
+            logger.info(f"[Task: {task_id}] Enhanced prompt for pipeline: {job.enhanced_prompt}")
+
+            prompt_keywords = [word for word in job.prompt.lower().split() if len(word) > 3]
+            job.title = generate_random_song_title(prompt_keywords)
+            logger.info(f"[Task: {task_id}] Generated title: '{job.title}'")
+
+            update_data = SSEEventData(status="processing", message=f"Crafting '{job.title}' with pipeline...", title=job.title)
+            if not model_resident(job.model_id):
+                update_data.message = f"Loading model {job.model_id}, then crafting '{job.title}'..."
+            publish_task_event(task_id, "update", update_data)
+
+        generation_params = {
+            "max_new_tokens": max(job.max_new_tokens for job in live_jobs),
+            "do_sample": True,
+            "guidance_scale": config.guidance_scale,
+        }
+        loop = asyncio.get_running_loop()
+        for job in live_jobs:
+            job.event_sink = functools.partial(publish_task_event_threadsafe, loop, job.task_id)
+            if job.stream:
+                job.chunk_sink = functools.partial(publish_audio_chunk, job.event_sink, [0])
+
+        batch_ids = ", ".join(job.task_id for job in live_jobs)
+        logger.info(f"[Batch: {batch_ids}] Pipeline generation_params: {generation_params} (batch size {len(live_jobs)})")
+
+        synthesize = inference_pool.synthesize_and_save_batch if inference_pool is not None else synthesize_and_save_batch
+        timings: Dict[str, float] = {}
+        durations = await loop.run_in_executor(executor, synthesize, live_jobs, generation_params, timings)
+        record_batch_metrics(live_jobs, generation_params, timings, durations)
+
+        for job, actual_duration in zip(live_jobs, durations):
+            task_id = job.task_id
+            if actual_duration is None:
+                logger.info(f"[Task: {task_id}] Cancelled while its batch was rendering; discarded its audio.")
+                continue
+            if job.cacheable:
+                result_cache.add(job.track_id)
+            output_filename_base = sanitize_filename(job.title)
+            client_suggested_filename = f"{output_filename_base}_{job.track_id[:8]}.wav"
+
+            complete_data = SSEEventData(
+                status="completed",
+                message="Generation successful!",
+                track_id=job.track_id,
+                title=job.title,
+                download_url=f"/music/download/{job.track_id}", # Note: Paths for client should be consistent
+                filename_suggestion=client_suggested_filename,
+                duration=actual_duration
+            )
+            publish_task_event(task_id, "complete", complete_data)
+
+    except GenerationCancelled as e:
+        logger.info(f"[Batch: {', '.join(job.task_id for job in live_jobs)}] Generation stopped early: {e}")
     except Exception as e:
-        logger.error(f"[Task: {task_id}] UNEXPECTED ERROR during pipeline music generation: {str(e)}", exc_info=True)
-        err_data = SSEEventData(status="error", message=f"Generation failed: {str(e)}")
-        await event_queue.put(SSEEvent(event="error", data=err_data).model_dump_json())
+        for job in live_jobs:
+            logger.error(f"[Task: {job.task_id}] UNEXPECTED ERROR during pipeline music generation: {str(e)}", exc_info=True)
+            err_data = SSEEventData(status="error", message=f"Generation failed: {str(e)}")
+            publish_task_event(job.task_id, "error", err_data)
+        GENERATIONS_TOTAL.inc(len(live_jobs), status="failed")
+    except asyncio.CancelledError:
+        # Shutdown: finish() below keeps open() from recovering these tasks, so close their streams here
+        for job in live_jobs:
+            record = task_store.get(job.task_id)
+            if record is not None and not record.finished:
+                logger.warning(f"[Task: {job.task_id}] Generation interrupted by server shutdown.")
+                err_data = SSEEventData(status="error", message="Generation interrupted by server shutdown.")
+                publish_task_event(job.task_id, "error", err_data)
+        raise
     finally:
-        if event_queue:
-            await event_queue.put(None)
+        for job in live_jobs:
+            task_store.finish(job.task_id)
+
+# --------------------------------------------------------------------------
+# Job Scheduler (bounded queue in front of the inference executor)
+# --------------------------------------------------------------------------
+class QueueFullError(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Generation queue is full. Retry after {retry_after}s.")
+        self.retry_after = retry_after
+
+class GenerationScheduler:
+    """
+    FIFO of pending GenerationJobs served by a dedicated thread pool.
+    Blocking pipeline calls run on the executor so the event loop keeps serving
+    health checks, downloads and SSE streams while a track is generating.
+    Jobs with a compatible token budget that arrive within the batching window
+    are micro-batched into a single pipeline forward pass.
+    """
+    def __init__(self, max_pending: int, concurrency: int, max_batch_size: int = 1, batch_window_ms: int = 0):
+        self.max_pending = max_pending
+        self.concurrency = concurrency
+        self.max_batch_size = max_batch_size
+        self.batch_window_seconds = batch_window_ms / 1000.0
+        self.active_jobs = 0
+        self._pending: Deque[GenerationJob] = deque()
+        self._running: Dict[str, GenerationJob] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._workers: List[asyncio.Task] = []
+        self._avg_job_seconds: Optional[float] = None
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="musicgen-inference")
+        self._workers = [asyncio.create_task(self._worker_loop(i)) for i in range(self.concurrency)]
+        logger.info(f"Generation scheduler started (concurrency={self.concurrency}, max_pending={self.max_pending}).")
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        logger.info("Generation scheduler stopped.")
+
+    def estimate_retry_after(self) -> int:
+        if self._avg_job_seconds is None:
+            return config.default_retry_after_seconds
+        backlog = len(self._pending) + self.active_jobs
+        return max(1, math.ceil(self._avg_job_seconds * backlog / self.concurrency))
+
+    def submit(self, job: GenerationJob) -> int:
+        """Enqueues a job and returns its 1-based queue position. Raises QueueFullError when full."""
+        if len(self._pending) >= self.max_pending:
+            raise QueueFullError(self.estimate_retry_after())
+        self._pending.append(job)
+        self._wakeup.set()
+        return len(self._pending)
+
+    def cancel(self, task_id: str) -> bool:
+        """Drops a pending job or flags a running one to stop at its next token step. Returns False if unknown."""
+        for job in self._pending:
+            if job.task_id == task_id:
+                self._pending.remove(job)
+                asyncio.create_task(self._broadcast_positions())
+                return True
+        job = self._running.get(task_id)
+        if job is None or job.cancel_event is None:
+            return False
+        job.cancel_event.set()
+        return True
+
+    async def _broadcast_positions(self):
+        for index, job in enumerate(list(self._pending)):
+            position = index + 1
+            queued_data = SSEEventData(status="queued", message=f"Waiting in queue (position {position}).", position=position)
+            publish_task_event(job.task_id, "queued", queued_data)
+
+    def _take_compatible(self, first: GenerationJob) -> Optional[GenerationJob]:
+        if not first.batchable:
+            return None
+        for job in self._pending:
+            if job.batchable and job.token_bucket == first.token_bucket and job.model_id == first.model_id:
+                self._pending.remove(job)
+                return job
+        return None
+
+    async def _collect_batch(self) -> List[GenerationJob]:
+        """Takes the oldest job plus any same-bucket jobs arriving within the batching window."""
+        batch = [self._pending.popleft()]
+        deadline = time.monotonic() + self.batch_window_seconds
+        while len(batch) < self.max_batch_size:
+            job = self._take_compatible(batch[0])
+            if job is not None:
+                batch.append(job)
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _worker_loop(self, worker_index: int):
+        while True:
+            while not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            batch = await self._collect_batch()
+            await self._broadcast_positions()
+
+            for job in batch:
+                wait_seconds = time.monotonic() - job.enqueued_at
+                STAGE_SECONDS.observe(wait_seconds, stage="queue_wait")
+                logger.info(f"[Task: {job.task_id}] Picked up by inference worker {worker_index} after {wait_seconds:.2f}s in queue (batch size {len(batch)}).")
+            self.active_jobs += len(batch)
+            self._running.update((job.task_id, job) for job in batch)
+            started_at = time.monotonic()
+            try:
+                await perform_music_generation_and_notify(batch, self._executor)
+            except Exception as e:
+                logger.error(f"Scheduler worker {worker_index} failed on batch of {len(batch)}: {e}", exc_info=True)
+            finally:
+                self.active_jobs -= len(batch)
+                for job in batch:
+                    self._running.pop(job.task_id, None)
+                # Track per-job cost so Retry-After estimates account for batching.
+                elapsed = (time.monotonic() - started_at) / len(batch)
+                self._avg_job_seconds = elapsed if self._avg_job_seconds is None else 0.8 * self._avg_job_seconds + 0.2 * elapsed
+
+scheduler = GenerationScheduler(
+    max_pending=config.max_pending_jobs,
+    concurrency=config.inference_processes or config.max_concurrent_generations,
+    max_batch_size=config.max_batch_size,
+    batch_window_ms=config.batch_window_ms,
+)
+
+def cancel_task(task_id: str, reason: str) -> bool:
+    """Ends a queued or running task with a `cancelled` event. Returns False if it had already finished."""
+    record = task_store.get(task_id)
+    if record is None or record.finished:
+        return False
+    if scheduler.cancel(task_id):
+        GENERATIONS_TOTAL.inc(status="cancelled")
+    logger.info(f"[Task: {task_id}] Cancelled: {reason}")
+    publish_task_event(task_id, "cancelled", SSEEventData(status="cancelled", message=reason))
+    task_store.finish(task_id)
+    return True
+
+def cancel_if_abandoned(task_id: str):
+    record = task_store.get(task_id)
+    if record is not None:
+        record.abandon_timer = None
+    if record is not None and not record.finished and not record.subscribers:
+        cancel_task(task_id, f"No client listened for {config.abandoned_task_grace_seconds}s.")
+
+# --------------------------------------------------------------------------
+# Download Helpers (transcoding cache and HTTP Range support)
+# --------------------------------------------------------------------------
+AUDIO_FORMATS = {
+    # format -> (soundfile format, soundfile subtype, media type)
+    "wav": (None, None, "audio/wav"),
+    "flac": ("FLAC", "PCM_16", "audio/flac"),
+    "ogg": ("OGG", "VORBIS", "audio/ogg"),
+}
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+_transcode_locks: Dict[str, asyncio.Lock] = {}
+
+def transcode_track(wav_path: str, audio_format: str) -> str:
+    """
+    Encodes a WAV into `audio_format` next to it and returns the encoded path.
+    The encoded file is reused until the WAV changes. Written to a temp file and
+    renamed so a concurrent download never sees a partial file.
+    """
+    if audio_format == "wav":
+        return wav_path
+    sf_format, sf_subtype, _ = AUDIO_FORMATS[audio_format]
+    encoded_path = f"{os.path.splitext(wav_path)[0]}.{audio_format}"
+    if os.path.isfile(encoded_path) and os.path.getmtime(encoded_path) >= os.path.getmtime(wav_path):
+        return encoded_path
+    audio, sample_rate = sf.read(wav_path, dtype="float32")
+    tmp_path = f"{encoded_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        sf.write(tmp_path, audio, sample_rate, format=sf_format, subtype=sf_subtype)
+        os.replace(tmp_path, encoded_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return encoded_path
+
+async def transcode_track_async(wav_path: str, audio_format: str) -> str:
+    encoded_path = f"{os.path.splitext(wav_path)[0]}.{audio_format}"
+    lock = _transcode_locks.setdefault(encoded_path, asyncio.Lock())
+    try:
+        async with lock:
+            return await asyncio.to_thread(transcode_track, wav_path, audio_format)
+    finally:
+        if not lock.locked():
+            _transcode_locks.pop(encoded_path, None)
+
+def iter_file_range(path: str, start: int, end: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def parse_byte_range(range_header: str, file_size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parses a single `bytes=start-end` range into inclusive offsets.
+    Returns None for multi-range or malformed headers (served as a full response);
+    raises ValueError for a syntactically valid but unsatisfiable range.
+    """
+    match = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", range_header)
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    if match.group(1) == "":
+        suffix_length = int(match.group(2))
+        if suffix_length == 0:
+            raise ValueError("Empty suffix range.")
+        return max(0, file_size - suffix_length), file_size - 1
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) else file_size - 1
+    if start >= file_size or end < start:
+        raise ValueError("Range not satisfiable.")
+    return start, min(end, file_size - 1)
+
+def ranged_file_response(request: Request, path: str, media_type: str, filename: str) -> Response:
+    """Serves a file with ETag/Last-Modified validation and single-range 206 responses."""
+    stat = os.stat(path)
+    etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, max-age=3600",
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+            return Response(status_code=304, headers=headers)
+    elif request.headers.get("if-modified-since"):
+        try:
+            if int(stat.st_mtime) <= parsedate_to_datetime(request.headers["if-modified-since"]).timestamp():
+                return Response(status_code=304, headers=headers)
+        except (TypeError, ValueError):
+            pass
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range.strip() == etag):
+        try:
+            byte_range = parse_byte_range(range_header, stat.st_size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{stat.st_size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            headers.update({
+                "Content-Range": f"bytes {start}-{end}/{stat.st_size}",
+                "Content-Length": str(end - start + 1),
+                "Content-Disposition": f'attachment; filename="{filename}"',
+            })
+            return StreamingResponse(iter_file_range(path, start, end), status_code=206, media_type=media_type, headers=headers)
+
+    return FileResponse(path, media_type=media_type, filename=filename, headers=headers, stat_result=stat)
 
 # --------------------------------------------------------------------------
 # API Endpoints
 # --------------------------------------------------------------------------
-@app.on_event("startup")
-async def startup_event():
-    logger.info("Application startup: Initializing Hugging Face pipeline...")
-    if not initialize_hf_pipeline():
-        logger.error("CRITICAL: Pipeline initialization failed on startup. API may not function correctly.")
+@app.get("/music/live", tags=["General"])
+async def liveness_probe():
+    """Liveness: the process is up and serving HTTP, whether or not the model has loaded."""
+    return {"status": "alive"}
+
+@app.get("/music/ready", tags=["General"])
+async def readiness_probe():
+    """Readiness: 200 once the model is loaded and warmed up and track storage is indexed, 503 while loading or after a failed load."""
+    if pipeline_ready():
+        return {"status": "ready", "model_id": config.model_id, "inference_backend": config.inference_backend}
+    load_error = model_registry.error(config.model_id) or output_storage_error
+    failed = load_error is not None or (inference_pool is not None and inference_pool.load_failed)
+    return JSONResponse(
+        status_code=503,
+        content={"status": "failed" if failed else "loading", "model_id": config.model_id, "error": load_error},
+    )
+
+@app.get("/music/models", tags=["General"])
+async def list_models():
+    """Configured models with their load state and memory use. In process-pool mode each worker reports its own."""
+    models = {config.model_id: {"names": [], "default": True}}
+    for name, model_id in config.available_models.items():
+        models.setdefault(model_id, {"names": [], "default": False})["names"].append(name)
+    if inference_pool is not None:
+        registries = {str(pid): snapshot for pid, snapshot in inference_pool.worker_models.items()}
+    else:
+        registries = {str(os.getpid()): model_registry.snapshot()}
+    for model_id, entry in models.items():
+        entry["processes"] = {
+            pid: snapshot["models"].get(model_id, {"state": "not_loaded"}) for pid, snapshot in registries.items()
+        }
+    return {
+        "default_model": config.model_id,
+        "models": models,
+        "memory": {
+            pid: {"budget_bytes": snapshot["budget_bytes"], "resident_bytes": snapshot["resident_bytes"]}
+            for pid, snapshot in registries.items()
+        },
+    }
 
 @app.get("/music/health", tags=["General"]) # Changed path prefix to /api/ for consistency
 async def health_check():
     """Checks API health and pipeline status."""
-    if synthesiser_pipeline is None:
+    if not pipeline_ready():
         raise HTTPException(status_code=503, detail="Music generation pipeline not initialized or loading failed.")
-    return {"status": "ok", "model_id": config.model_id, "message": "API is healthy and pipeline is loaded."}
+    return {
+        "status": "ok",
+        "model_id": config.model_id,
+        "message": "API is healthy and pipeline is loaded.",
+        "queue": {"pending": scheduler.pending_count, "active": scheduler.active_jobs, "max_pending": scheduler.max_pending},
+        "result_cache": result_cache.stats(),
+        "storage": track_storage.stats(),
+        "text_encoder_cache": text_conditioning_cache.stats(),
+        "tasks": task_store.stats(),
+    }
 
-@app.post("/music/generate", response_model=InitialGenerationResponse, tags=["Music Generation"]) # Changed path
-async def initiate_generation_endpoint(
-    request_data: GenerationRequest, background_tasks: BackgroundTasks
-):
+@app.get("/music/metrics", tags=["General"])
+async def metrics_endpoint():
+    """Prometheus text-format metrics: per-stage latency histograms, throughput, queue and memory gauges."""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.post(
+    "/music/generate",
+    response_model=InitialGenerationResponse,
+    tags=["Music Generation"],
+    responses={429: {"description": "Generation queue is full. Honour the Retry-After header."}},
+) # Changed path
+async def initiate_generation_endpoint(request_data: GenerationRequest):
     """Initiates music generation and returns a task ID for SSE streaming."""
-    if synthesiser_pipeline is None:
+    if not pipeline_ready():
         logger.error("Generate request received but pipeline not ready.")
         raise HTTPException(status_code=503, detail="Pipeline not ready. Please try again shortly.")
 
+    try:
+        model_id = resolve_requested_model(request_data.model)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
     task_id = str(uuid.uuid4())
-    task_event_queues[task_id] = asyncio.Queue()
-    logger.info(f"Task {task_id} created for prompt: '{request_data.prompt}' (using pipeline)")
-
-    background_tasks.add_task(
-        perform_music_generation_and_notify,
-        task_id,
-        request_data.prompt,
-        request_data.duration,
-        request_data.genre,
-        request_data.instruments,
-        request_data.tempo
+    job = GenerationJob(
+        task_id=task_id,
+        model_id=model_id,
+        prompt=request_data.prompt,
+        duration=request_data.duration,
+        genre=request_data.genre,
+        instruments=request_data.instruments,
+        tempo=request_data.tempo,
+        stream=request_data.stream,
+        seed=request_data.seed,
+        profile=request_data.profile,
+        track_id=task_id,
+        cancel_event=new_cancel_event(),
     )
+    enhance_started_at = time.perf_counter()
+    job.enhanced_prompt = build_enhanced_prompt(request_data.prompt, request_data.genre, request_data.instruments, request_data.tempo)
+    STAGE_SECONDS.observe(time.perf_counter() - enhance_started_at, stage="prompt_enhancement")
+
+    if config.result_cache_enabled and (job.seed is not None or config.cache_unseeded_requests):
+        job.cacheable = True
+        job.track_id = ResultCache.track_id_for(
+            job.model_id, job.enhanced_prompt, job.requested_tokens, config.guidance_scale, job.seed
+        )
+        cached_path = result_cache.lookup(job.track_id)
+        if cached_path is not None:
+            logger.info(f"Task {task_id} served from result cache (track {job.track_id}).")
+            prompt_keywords = [word for word in job.prompt.lower().split() if len(word) > 3]
+            title = generate_random_song_title(prompt_keywords)
+            complete_data = SSEEventData(
+                status="completed",
+                message="Generation successful! (cached)",
+                track_id=job.track_id,
+                title=title,
+                download_url=f"/music/download/{job.track_id}",
+                filename_suggestion=f"{sanitize_filename(title)}_{job.track_id[:8]}.wav",
+                duration=sf.info(cached_path).duration,
+            )
+            task_store.create(task_id)
+            publish_task_event(task_id, "complete", complete_data)
+            task_store.finish(task_id)
+            REQUESTS_TOTAL.inc(outcome="cached")
+            return InitialGenerationResponse(
+                task_id=task_id,
+                status="completed",
+                message="Track served from cache. Connect to stream URL for the result.",
+                stream_url=f"/music/stream-generation/{task_id}"
+            )
+
+    task_store.create(task_id)
+    try:
+        position = scheduler.submit(job)
+    except QueueFullError as e:
+        task_store.discard(task_id)
+        REQUESTS_TOTAL.inc(outcome="rejected")
+        logger.warning(f"Rejecting generate request, queue full ({scheduler.pending_count} pending). Retry-After: {e.retry_after}s")
+        raise HTTPException(
+            status_code=429,
+            detail="Too many pending generation requests. Please try again later.",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    REQUESTS_TOTAL.inc(outcome="queued")
+    logger.info(f"Task {task_id} queued at position {position} for prompt: '{request_data.prompt}' (using pipeline)")
+
+    queued_data = SSEEventData(status="queued", message=f"Waiting in queue (position {position}).", position=position)
+    publish_task_event(task_id, "queued", queued_data)
     return InitialGenerationResponse(
         task_id=task_id,
         status="queued",
-        message="Music generation task initiated (pipeline). Connect to stream URL for updates.",
+        message=f"Music generation task queued at position {position} (pipeline). Connect to stream URL for updates.",
         stream_url=f"/music/stream-generation/{task_id}" # Path consistent with other /api/ routes
     )
 
 async def sse_event_generator(task_id: str, http_request: Request):
-    event_queue = task_event_queues.get(task_id)
-    if not event_queue:
-        logger.warning(f"SSE stream request for unknown or completed task_id: {task_id}")
+    record = task_store.get(task_id)
+    if record is None:
+        logger.warning(f"SSE stream request for unknown or expired task_id: {task_id}")
         error_data = SSEEventData(status="error", message="Invalid or unknown task ID for streaming.")
         yield SSEEvent(event="error", data=error_data).model_dump_json()
         return
 
-    logger.info(f"SSE connection established for task: {task_id}")
     try:
+        last_event_id = int(http_request.headers.get("last-event-id", "0"))
+    except ValueError:
+        last_event_id = 0
+    logger.info(f"SSE connection established for task: {task_id} (replaying after event {last_event_id})")
+    event_queue = task_store.subscribe(task_id)
+    SSE_CONNECTIONS.inc()
+    try:
+        for event_id, _, event_json_str in list(record.events):
+            if event_id > last_event_id:
+                yield {"id": str(event_id), "data": event_json_str}
+                last_event_id = event_id
+        if record.finished:
+            return
         while True:
             if await http_request.is_disconnected():
                 logger.info(f"Client disconnected from SSE stream for task: {task_id}")
                 break
             try:
-                event_json_str = await asyncio.wait_for(event_queue.get(), timeout=1.0)
-                if event_json_str is None:
+                item = await asyncio.wait_for(event_queue.get(), timeout=1.0)
+                if item is None:
                     logger.info(f"End of event stream signaled for task: {task_id}")
                     break
-                yield event_json_str
+                event_id, event_json_str, published_at = item
+                if event_id > last_event_id:
+                    yield {"id": str(event_id), "data": event_json_str}
+                    # The generator resumes once the event has been written to the client
+                    STAGE_SECONDS.observe(time.perf_counter() - published_at, stage="sse_delivery")
+                    last_event_id = event_id
             except asyncio.TimeoutError:
                 continue
     except Exception as e:
@@ -338,32 +2403,70 @@ async def sse_event_generator(task_id: str, http_request: Request):
             yield SSEEvent(event="error", data=err_data).model_dump_json()
         except Exception: pass
     finally:
-        logger.info(f"Closing SSE stream and cleaning up queue for task: {task_id}")
-        if task_id in task_event_queues:
-            q = task_event_queues[task_id]
-            while not q.empty():
-                try: q.get_nowait(); q.task_done()
-                except asyncio.QueueEmpty: break
-            del task_event_queues[task_id]
+        logger.info(f"Closing SSE stream for task: {task_id}")
+        SSE_CONNECTIONS.dec()
+        task_store.unsubscribe(task_id, event_queue)
+        if config.abandoned_task_grace_seconds is not None and not record.finished and not record.subscribers:
+            if record.abandon_timer is not None:
+                record.abandon_timer.cancel()
+            record.abandon_timer = asyncio.get_running_loop().call_later(
+                config.abandoned_task_grace_seconds, cancel_if_abandoned, task_id
+            )
 
 @app.get("/music/stream-generation/{task_id}", tags=["Music Generation"]) # Changed path
 async def stream_generation_events(task_id: str, request: Request):
     """SSE endpoint to stream generation progress and results."""
     return EventSourceResponse(sse_event_generator(task_id, request), media_type="text/event-stream")
 
+@app.get("/music/tasks/{task_id}", tags=["Music Generation"])
+async def get_task_status(task_id: str):
+    """Returns the current status of a generation task."""
+    record = task_store.get(task_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired task ID.")
+    return {
+        "task_id": task_id,
+        "status": record.status,
+        "created_at": record.created_at,
+        "finished_at": record.finished_at,
+        "event_count": len(record.events),
+        "subscribers": len(record.subscribers),
+    }
+
+@app.delete("/music/tasks/{task_id}", tags=["Music Generation"])
+async def cancel_task_endpoint(task_id: str):
+    """Cancels a queued or running task. A running generation stops at its next token step."""
+    record = task_store.get(task_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired task ID.")
+    if not cancel_task(task_id, "Cancelled by client."):
+        raise HTTPException(status_code=409, detail=f"Task already finished with status '{record.status}'.")
+    return {"task_id": task_id, "status": "cancelled"}
+
 @app.get("/music/download/{track_id}", tags=["Music Generation"]) # Changed path
-async def download_generated_track(track_id: str):
-    """Downloads the generated audio file for the given track_id."""
+async def download_generated_track(
+    track_id: str,
+    request: Request,
+    format: str = Query("wav", pattern="^(wav|flac|ogg)$", description="Audio format. FLAC/Ogg are encoded once and cached on disk."),
+):
+    """Downloads the generated audio file for the given track_id. Supports Range requests for seeking."""
     try:
         uuid.UUID(track_id)
-        file_path = os.path.join(config.output_dir, f"{track_id}.wav")
-        if not os.path.exists(file_path) or not os.path.isfile(file_path):
-            logger.warning(f"Download request for non-existent track: {track_id} (Path: {file_path})")
-            raise HTTPException(status_code=404, detail="Track not found or generation incomplete/failed.")
-        return FileResponse(file_path, media_type="audio/wav", filename=f"musicgen_pipeline_{track_id}.wav")
     except ValueError:
         logger.warning(f"Download request with invalid track_id format: {track_id}")
         raise HTTPException(status_code=400, detail="Invalid track ID format.")
+    if not output_storage_loaded:
+        raise HTTPException(status_code=503, detail="Track storage is still loading. Please try again shortly.")
+    try:
+        file_path = track_storage.lookup(track_id)
+        if file_path is None:
+            logger.warning(f"Download request for non-existent or evicted track: {track_id}")
+            raise HTTPException(status_code=404, detail="Track not found, evicted, or generation incomplete/failed.")
+        if format != "wav":
+            file_path = await transcode_track_async(file_path, format)
+            track_storage.add(track_id) # Counts a newly encoded copy against the quota
+        media_type = AUDIO_FORMATS[format][2]
+        return ranged_file_response(request, file_path, media_type, f"musicgen_pipeline_{track_id}.{format}")
     except HTTPException: raise
     except Exception as e:
         logger.error(f"Unexpected error in download endpoint for track_id {track_id}: {e}", exc_info=True)
@@ -381,7 +2484,6 @@ if __name__ == "__main__":
                      # If e.g. server.py, use "server:app".
         host="0.0.0.0",
         port=port,
-        reload=True,
         workers=1,
         log_level="info"
     )
\ No newline at end of file
@@ -0,0 +1,240 @@
+"""
+Load test and latency benchmark for the MusicGen API.
+
+Starts the FastAPI app under uvicorn in a background thread, then sends
+/music/generate requests at a fixed arrival rate (or as fast as the concurrency
+limit allows) and follows each task's SSE stream. It reports p50/p95/p99 for:
+
+- time-to-queued: POST /music/generate answered
+- time-to-first-event: first SSE event received
+- time-to-complete: `complete` event received
+
+It also reports throughput, rejected (429) requests, and event-loop lag measured
+on the server's loop.
+
+By default the default model is replaced by FakePipeline, a deterministic
+stand-in with configurable latency and output shape, so no model weights are
+needed. --real-model loads the configured model instead and also reports
+generated tokens/s.
+
+Usage:
+    python benchmark_api.py --requests 50 --concurrency 8 --rate 4
+    python benchmark_api.py --fake-latency-per-token 0.002 --max-batch-size 1
+    python benchmark_api.py --real-model --requests 4 --duration 5
+"""
+import argparse
+import asyncio
+import json
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import httpx
+import numpy as np
+import uvicorn
+
+import app
+
+
+class FakePipeline:
+    """
+    Stands in for the Hugging Face text-to-audio pipeline. Sleeps for
+    `base_latency + per_token_latency * max_new_tokens`, scaled by `batch_cost`
+    for every extra prompt in a batch. Returns silence of the matching length
+    in the given shape.
+    """
+    def __init__(self, base_latency: float, per_token_latency: float, batch_cost: float,
+                 sampling_rate: int = 32000, samples_per_token: int = 640, output_shape: str = "1,1,N"):
+        self.base_latency = base_latency
+        self.per_token_latency = per_token_latency
+        self.batch_cost = batch_cost
+        self.sampling_rate = sampling_rate
+        self.samples_per_token = samples_per_token
+        self.output_shape = output_shape
+
+    def _audio(self, max_new_tokens: int) -> np.ndarray:
+        samples = max_new_tokens * self.samples_per_token
+        shape = tuple(samples if dim == "N" else int(dim) for dim in self.output_shape.split(","))
+        return np.zeros(shape, dtype=np.float32)
+
+    def __call__(self, text_inputs, forward_params=None, batch_size: Optional[int] = None):
+        max_new_tokens = forward_params["max_new_tokens"]
+        prompts = text_inputs if isinstance(text_inputs, list) else [text_inputs]
+        latency = self.base_latency + self.per_token_latency * max_new_tokens
+        time.sleep(latency * (1 + self.batch_cost * (len(prompts) - 1)))
+        outputs = [{"audio": self._audio(max_new_tokens), "sampling_rate": self.sampling_rate} for _ in prompts]
+        return outputs if isinstance(text_inputs, list) else outputs[0]
+
+
+@dataclass
+class RequestResult:
+    status_code: int = 0
+    time_to_queued: Optional[float] = None
+    time_to_first_event: Optional[float] = None
+    time_to_complete: Optional[float] = None
+    tokens: int = 0
+    error: Optional[str] = None
+
+
+@dataclass
+class ServerHandle:
+    server: uvicorn.Server
+    thread: threading.Thread
+    base_url: str
+    loop_lag: List[float] = field(default_factory=list)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def probe_loop_lag(samples: List[float], interval: float = 0.01):
+    while True:
+        started_at = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started_at - interval)
+
+
+def start_server() -> ServerHandle:
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app.app, host="127.0.0.1", port=port, log_level="warning", lifespan="on"))
+    handle = ServerHandle(server=server, thread=None, base_url=f"http://127.0.0.1:{port}")
+
+    async def serve():
+        probe = asyncio.create_task(probe_loop_lag(handle.loop_lag))
+        try:
+            await server.serve()
+        finally:
+            probe.cancel()
+
+    handle.thread = threading.Thread(target=lambda: asyncio.run(serve()), name="benchmark-server", daemon=True)
+    handle.thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return handle
+
+
+async def run_one_request(client: httpx.AsyncClient, payload: dict, timeout: float) -> RequestResult:
+    result = RequestResult(tokens=min(int(payload["duration"] * app.config.tokens_per_second_approx), app.config.max_generation_tokens_cap))
+    started_at = time.perf_counter()
+    try:
+        response = await client.post("/music/generate", json=payload)
+        result.status_code = response.status_code
+        result.time_to_queued = time.perf_counter() - started_at
+        if response.status_code != 200:
+            return result
+        async with client.stream("GET", response.json()["stream_url"], timeout=timeout) as stream:
+            async for line in stream.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                if result.time_to_first_event is None:
+                    result.time_to_first_event = time.perf_counter() - started_at
+                event = json.loads(line[len("data:"):].strip())
+                if event["event"] == "complete":
+                    result.time_to_complete = time.perf_counter() - started_at
+                    break
+                if event["event"] == "error":
+                    result.error = event["data"].get("message")
+                    break
+    except Exception as e:
+        result.error = str(e)
+    return result
+
+
+async def drive_load(base_url: str, args) -> List[RequestResult]:
+    semaphore = asyncio.Semaphore(args.concurrency)
+    prompts = ["lofi hip hop beat with soft piano", "upbeat jazz with saxophone", "ambient synth pads", "driving techno groove"]
+
+    async def one(index: int):
+        async with semaphore:
+            payload = {"prompt": prompts[index % len(prompts)], "duration": args.duration}
+            return await run_one_request(client, payload, args.timeout)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout) as client:
+        tasks = []
+        for index in range(args.requests):
+            tasks.append(asyncio.create_task(one(index)))
+            if args.rate > 0:
+                await asyncio.sleep(random.expovariate(args.rate)) # Poisson arrivals
+        return await asyncio.gather(*tasks)
+
+
+def percentiles(values: List[float]) -> str:
+    if not values:
+        return "n/a"
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return f"p50={p50 * 1000:8.1f}ms  p95={p95 * 1000:8.1f}ms  p99={p99 * 1000:8.1f}ms"
+
+
+def report(results: List[RequestResult], wall_seconds: float, loop_lag: List[float], real_model: bool):
+    completed = [r for r in results if r.time_to_complete is not None]
+    rejected = [r for r in results if r.status_code == 429]
+    failed = [r for r in results if r.error]
+    print(f"requests: {len(results)}  completed: {len(completed)}  rejected(429): {len(rejected)}  failed: {len(failed)}")
+    print(f"wall time: {wall_seconds:.2f}s  throughput: {len(completed) / wall_seconds:.2f} tracks/s")
+    print(f"time-to-queued      {percentiles([r.time_to_queued for r in results if r.time_to_queued is not None])}")
+    print(f"time-to-first-event {percentiles([r.time_to_first_event for r in results if r.time_to_first_event is not None])}")
+    print(f"time-to-complete    {percentiles([r.time_to_complete for r in completed])}")
+    print(f"event-loop lag      {percentiles(loop_lag)}  max={max(loop_lag, default=0) * 1000:.1f}ms")
+    if real_model:
+        print(f"generated tokens/s: {sum(r.tokens for r in completed) / wall_seconds:.1f}")
+    for r in failed[:5]:
+        print(f"  error: {r.error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum requests in flight from the client.")
+    parser.add_argument("--rate", type=float, default=0, help="Mean arrival rate in requests/s (0 = as fast as concurrency allows).")
+    parser.add_argument("--duration", type=float, default=10.0, help="Requested track duration in seconds.")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--real-model", action="store_true", help="Load the configured model instead of the fake pipeline.")
+    parser.add_argument("--fake-latency", type=float, default=0.2, help="Fake pipeline fixed latency per call (s).")
+    parser.add_argument("--fake-latency-per-token", type=float, default=0.001, help="Fake pipeline latency per token (s).")
+    parser.add_argument("--fake-batch-cost", type=float, default=0.25, help="Extra latency per additional batched prompt, as a fraction.")
+    parser.add_argument("--fake-output-shape", default="1,1,N", help="Audio array shape returned by the fake pipeline, N = samples.")
+    parser.add_argument("--max-batch-size", type=int, help="Override MusicGenConfig.max_batch_size.")
+    parser.add_argument("--batch-window-ms", type=int, help="Override MusicGenConfig.batch_window_ms.")
+    parser.add_argument("--max-pending", type=int, help="Override MusicGenConfig.max_pending_jobs.")
+    args = parser.parse_args()
+
+    output_dir = tempfile.mkdtemp(prefix="musicgen-bench-")
+    app.config.output_dir = app.track_storage.directory = output_dir
+    if args.max_batch_size is not None:
+        app.scheduler.max_batch_size = args.max_batch_size
+    if args.batch_window_ms is not None:
+        app.scheduler.batch_window_seconds = args.batch_window_ms / 1000.0
+    if args.max_pending is not None:
+        app.scheduler.max_pending = args.max_pending
+
+    if args.real_model:
+        if not app.initialize_hf_pipeline():
+            sys.exit("Failed to load the real model.")
+    else:
+        app.text_conditioning_cache.max_bytes = 0 # The fake has no text encoder; route batches through the pipeline call
+        app.model_registry.add(app.config.model_id, FakePipeline(
+            args.fake_latency, args.fake_latency_per_token, args.fake_batch_cost, output_shape=args.fake_output_shape
+        ))
+
+    handle = start_server()
+    try:
+        started_at = time.perf_counter()
+        results = asyncio.run(drive_load(handle.base_url, args))
+        wall_seconds = time.perf_counter() - started_at
+    finally:
+        handle.server.should_exit = True
+        handle.thread.join(timeout=10)
+    report(results, wall_seconds, handle.loop_lag, args.real_model)
+    print(f"(tracks written to {output_dir})", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
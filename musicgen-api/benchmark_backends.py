@@ -0,0 +1,126 @@
+"""
+Compares MusicGen inference backends (fp32 eager, int8 dynamic quantization,
+bf16 autocast, torch.compile) on this machine.
+
+Each backend runs in its own subprocess so peak RSS is measured in isolation.
+The report shows load/warm-up time, generation tokens/s, peak RSS and a
+spectral similarity against the fp32 baseline. The audio differs sample by sample
+once sampling diverges, so the similarity compares the long-term average spectrum.
+Treat it as a sanity check that a backend still sounds like music, not a
+fidelity score.
+
+Usage:
+    python benchmark_backends.py
+    python benchmark_backends.py --backends fp32 int8 --tokens 500 --threads 8
+    python benchmark_backends.py --model /models/musicgen-small
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+PROMPT = "A calming lofi hip hop beat with a soft piano melody"
+
+
+def run_single_backend(backend: str, model_id: str, tokens: int, seed: int, threads: int, audio_path: str) -> dict:
+    import torch
+    import app
+
+    if threads:
+        torch.set_num_threads(threads)
+    app.config.inference_backend = backend
+    if model_id:
+        app.config.model_id = model_id
+
+    started_at = time.monotonic()
+    if not app.initialize_hf_pipeline():
+        raise SystemExit(f"Pipeline failed to load for backend {backend}")
+    load_seconds = time.monotonic() - started_at
+
+    pipe = app.model_registry.get(app.config.model_id)
+    torch.manual_seed(seed)
+    started_at = time.monotonic()
+    with app.inference_autocast():
+        output = pipe(
+            PROMPT,
+            forward_params={"max_new_tokens": tokens, "do_sample": True, "guidance_scale": app.config.guidance_scale},
+        )
+    generate_seconds = time.monotonic() - started_at
+
+    waveform = app.normalize_audio_shape(f"bench-{backend}", output["audio"]).astype(np.float32)
+    np.save(audio_path, waveform)
+    return {
+        "backend": backend,
+        "load_and_warmup_s": round(load_seconds, 2),
+        "generate_s": round(generate_seconds, 2),
+        "tokens_per_s": round(tokens / generate_seconds, 2),
+        "realtime_factor": round(len(waveform) / output["sampling_rate"] / generate_seconds, 3),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def average_log_spectrum(waveform: np.ndarray, frame: int = 2048, hop: int = 1024) -> np.ndarray:
+    if len(waveform) < frame:
+        waveform = np.pad(waveform, (0, frame - len(waveform)))
+    frames = np.lib.stride_tricks.sliding_window_view(waveform, frame)[::hop] * np.hanning(frame)
+    magnitudes = np.abs(np.fft.rfft(frames, axis=-1))
+    return np.log1p(magnitudes).mean(axis=0)
+
+
+def spectral_similarity(reference: np.ndarray, candidate: np.ndarray) -> float:
+    a, b = average_log_spectrum(reference), average_log_spectrum(candidate)
+    return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b) + 1e-12))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=["fp32", "int8", "bf16", "compile"])
+    parser.add_argument("--model", default="", help="Model id or local path (defaults to MusicGenConfig.model_id).")
+    parser.add_argument("--tokens", type=int, default=250, help="Tokens to generate per backend (~50 per second of audio).")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--threads", type=int, default=0, help="torch.set_num_threads (0 keeps the torch default).")
+    parser.add_argument("--worker", help=argparse.SUPPRESS) # Internal: run one backend and print JSON
+    parser.add_argument("--audio-out", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_single_backend(args.worker, args.model, args.tokens, args.seed, args.threads, args.audio_out)))
+        return
+
+    backends = ["fp32"] + [b for b in args.backends if b != "fp32"] # fp32 is always the reference
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for backend in backends:
+            audio_path = os.path.join(tmp_dir, f"{backend}.npy")
+            print(f"Benchmarking {backend}...", file=sys.stderr)
+            completed = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--worker", backend, "--audio-out", audio_path,
+                 "--model", args.model, "--tokens", str(args.tokens), "--seed", str(args.seed), "--threads", str(args.threads)],
+                capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+            )
+            if completed.returncode != 0:
+                print(f"  {backend} failed:\n{completed.stderr[-2000:]}", file=sys.stderr)
+                continue
+            results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+        baseline = os.path.join(tmp_dir, "fp32.npy")
+        for result in results:
+            if os.path.exists(baseline):
+                result["similarity_vs_fp32"] = round(spectral_similarity(
+                    np.load(baseline), np.load(os.path.join(tmp_dir, f"{result['backend']}.npy"))
+                ), 4)
+
+    columns = ["backend", "load_and_warmup_s", "generate_s", "tokens_per_s", "realtime_factor", "peak_rss_mb", "similarity_vs_fp32"]
+    print(" | ".join(f"{c:>18}" for c in columns))
+    for result in results:
+        print(" | ".join(f"{str(result.get(c, '-')):>18}" for c in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""
+Offline bulk generation: renders every record of a JSONL manifest without going
+through HTTP/SSE.
+
+Each input line is a GenerationRequest-shaped JSON object (prompt, model,
+duration, genre, instruments, tempo, seed) with an optional "id". Records without
+an id are named after their line number. Unknown keys are ignored. Jobs are
+bucketed by model and token count, so similar-length tracks share a forward
+pass. Batches run longest first across worker processes: one process per CUDA
+device, or CPU processes with a fixed torch thread count each.
+
+Tracks are written through the service's track storage as
+<output-dir>/<shard>/<id>.wav, with quota and age eviction turned off. Each
+result line's "track" holds that path relative to --output-dir. One JSON line
+per record is appended to the results manifest (default <output-dir>/results.jsonl) as soon as
+its batch finishes, and the line is fsynced. The manifest doubles as the
+checkpoint: rerunning the same command skips records that already have a
+"completed" line and retries everything else. A record with a "completed" line
+stays completed whatever lines follow it; otherwise its last line wins. A
+duplicate id is reported under "line-<n>" so it never shadows the original.
+
+Usage:
+    python generate_bulk.py catalog.jsonl --output-dir ./catalog
+    python generate_bulk.py catalog.jsonl --output-dir ./catalog --processes 4 --threads 4 --format flac
+    python generate_bulk.py catalog.jsonl --output-dir ./catalog --batch-size 8 --model musicgen-medium
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple
+
+from pydantic import ValidationError
+
+import app
+
+
+def read_manifest(path: str, default_model: Optional[str]) -> Tuple[List[app.GenerationJob], List[dict]]:
+    """Parses the input JSONL into jobs. Returns (jobs, invalid) where invalid holds one result line per rejected record."""
+    jobs, invalid, seen_tracks = [], [], set()
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            record_id = f"line-{line_number}"
+            try:
+                record = json.loads(line)
+                record_id = str(record.get("id", record_id))
+                request = app.GenerationRequest(**record)
+                model_id = app.resolve_requested_model(request.model or default_model)
+            except (json.JSONDecodeError, AttributeError, TypeError, ValidationError, ValueError) as e:
+                invalid.append({"id": record_id, "status": "invalid", "error": str(e)})
+                continue
+            track_id = app.sanitize_filename(record_id, default_name=f"line-{line_number}")
+            if track_id in seen_tracks:
+                invalid.append({
+                    "id": f"line-{line_number}",
+                    "status": "invalid",
+                    "duplicate_of": record_id,
+                    "error": f"Duplicate id (output '{track_id}.wav' is already taken).",
+                })
+                continue
+            seen_tracks.add(track_id)
+            jobs.append(app.GenerationJob(
+                task_id=record_id,
+                prompt=request.prompt,
+                duration=request.duration,
+                genre=request.genre,
+                instruments=request.instruments,
+                tempo=request.tempo,
+                model_id=model_id,
+                seed=request.seed,
+                enhanced_prompt=app.build_enhanced_prompt(request.prompt, request.genre, request.instruments, request.tempo),
+                track_id=track_id,
+            ))
+    return jobs, invalid
+
+
+def read_results(results_path: str) -> Dict[str, dict]:
+    """Result per record id: its completed line if it has one, else its latest line."""
+    latest: Dict[str, dict] = {}
+    if os.path.exists(results_path):
+        with open(results_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    continue # A line cut short by a crash mid-write
+                if latest.get(result["id"], {}).get("status") != "completed":
+                    latest[result["id"]] = result
+    return latest
+
+
+def plan_batches(jobs: List[app.GenerationJob], batch_size: int) -> List[List[app.GenerationJob]]:
+    """
+    Groups batchable jobs by (model, token bucket) into batches of up to batch_size.
+    Seeded and long-form jobs run alone. Batches are ordered longest first so the
+    slowest ones don't start last and leave the other workers idle at the end.
+    """
+    buckets: Dict[Tuple[str, int], List[app.GenerationJob]] = {}
+    batches = []
+    for job in sorted(jobs, key=lambda job: job.requested_tokens, reverse=True):
+        if job.batchable:
+            buckets.setdefault((job.model_id, job.token_bucket), []).append(job)
+        else:
+            batches.append([job])
+    for bucket_jobs in buckets.values():
+        batches.extend(bucket_jobs[i:i + batch_size] for i in range(0, len(bucket_jobs), batch_size))
+    batches.sort(key=lambda batch: max(job.requested_tokens for job in batch), reverse=True)
+    return batches
+
+
+def _init_bulk_worker(device_queue, torch_threads: int, parent_config: app.MusicGenConfig):
+    if device_queue is not None:
+        # load_pipeline always uses cuda:0; pin each worker to its own device before torch initializes CUDA
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(device_queue.get())
+    vars(app.config).update(vars(parent_config))
+    app.track_storage.directory = app.config.output_dir
+    app.track_storage.max_bytes = app.config.output_max_bytes
+    app.track_storage.max_age_seconds = app.config.output_max_age_seconds
+    app.track_storage.sample_subtype = app.config.output_sample_subtype
+    app.model_registry.budget_bytes = app.config.model_memory_budget_bytes
+    app.text_conditioning_cache.max_bytes = app.config.text_encoder_cache_max_bytes
+    import torch
+    torch.set_num_threads(torch_threads)
+    if not app.initialize_hf_pipeline():
+        raise RuntimeError(f"Bulk worker {os.getpid()} failed to load {app.config.model_id}")
+
+
+def _render_batch(jobs: List[app.GenerationJob]) -> List[float]:
+    generation_params = {
+        "max_new_tokens": max(job.max_new_tokens for job in jobs),
+        "do_sample": True,
+        "guidance_scale": app.config.guidance_scale,
+    }
+    timings: Dict[str, float] = {}
+    return app.synthesize_and_save_batch(jobs, generation_params, timings)
+
+
+class ResultsManifest:
+    """Append-only JSONL results file; every line is flushed and fsynced before the next batch is recorded."""
+    def __init__(self, path: str):
+        self._file = open(path, "a", encoding="utf-8")
+
+    def append(self, result: dict):
+        self._file.write(json.dumps(result) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("manifest", help="JSONL file with one GenerationRequest-shaped record per line.")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--results", help="Results manifest path (default <output-dir>/results.jsonl).")
+    parser.add_argument("--model", help="Model name or id for records that don't set one (defaults to MusicGenConfig.model_id).")
+    parser.add_argument("--batch-size", type=int, default=app.config.max_batch_size, help="Maximum jobs per forward pass.")
+    parser.add_argument("--processes", type=int, default=0, help="Worker processes (default: one per CUDA device, else cpu_count // threads).")
+    parser.add_argument("--threads", type=int, default=4, help="torch threads per CPU worker process.")
+    parser.add_argument("--format", choices=["flac", "ogg"], help="Also encode every track to this format.")
+    parser.add_argument("--sample-format", choices=["PCM_16", "FLOAT"], default=app.config.output_sample_subtype, help="WAV sample format.")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    app.config.output_dir = app.track_storage.directory = args.output_dir
+    app.config.output_max_bytes = app.config.output_max_age_seconds = None # A catalog is kept whole
+    app.config.output_sample_subtype = args.sample_format
+    app.config.eager_transcode_format = args.format
+    results_path = args.results or os.path.join(args.output_dir, "results.jsonl")
+
+    try:
+        jobs, invalid = read_manifest(args.manifest, args.model)
+    except ValueError as e: # Unknown --model
+        sys.exit(str(e))
+    previous_results = read_results(results_path)
+    pending = [job for job in jobs if previous_results.get(job.task_id, {}).get("status") != "completed"]
+    batches = plan_batches(pending, max(1, args.batch_size))
+    print(f"{len(jobs)} records: {len(jobs) - len(pending)} already completed, {len(pending)} to render "
+          f"in {len(batches)} batches, {len(invalid)} invalid.", file=sys.stderr)
+
+    results = ResultsManifest(results_path)
+    for result in invalid:
+        print(f"  skipping {result['id']}: {result['error']}", file=sys.stderr)
+        if previous_results.get(result["id"]) != result:
+            results.append(result)
+    if not batches:
+        results.close()
+        return
+
+    import torch
+    devices = torch.cuda.device_count()
+    context = multiprocessing.get_context("spawn")
+    device_queue = None
+    if devices:
+        processes = args.processes or devices
+        device_queue = context.Queue()
+        for index in range(processes):
+            device_queue.put(index % devices)
+        torch_threads = args.threads
+    else:
+        processes = args.processes or max(1, (os.cpu_count() or 1) // args.threads)
+        torch_threads = args.threads
+    processes = min(processes, len(batches))
+    print(f"Rendering with {processes} processes ({'CUDA' if devices else f'CPU, {torch_threads} torch threads each'}).", file=sys.stderr)
+
+    started_at = time.monotonic()
+    done = failed = 0
+    executor = ProcessPoolExecutor(
+        max_workers=processes, mp_context=context,
+        initializer=_init_bulk_worker, initargs=(device_queue, torch_threads, app.config),
+    )
+    try:
+        futures = {executor.submit(_render_batch, batch): batch for batch in batches}
+        while futures:
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                batch = futures.pop(future)
+                error = future.exception()
+                for index, job in enumerate(batch):
+                    if error is not None:
+                        failed += 1
+                        results.append({"id": job.task_id, "status": "failed", "error": str(error)})
+                        continue
+                    done += 1
+                    results.append({
+                        "id": job.task_id,
+                        "status": "completed",
+                        "track": os.path.relpath(app.track_storage.path(job.track_id), args.output_dir),
+                        "duration": round(future.result()[index], 3),
+                        "model": job.model_id,
+                        "prompt": job.enhanced_prompt,
+                        "seed": job.seed,
+                    })
+                elapsed = time.monotonic() - started_at
+                print(f"[{done + failed}/{len(pending)}] batch of {len(batch)} "
+                      f"{'failed: ' + str(error) if error else 'done'} ({elapsed:.0f}s elapsed)", file=sys.stderr)
+    except KeyboardInterrupt:
+        print("Interrupted; rerun the same command to resume.", file=sys.stderr)
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise SystemExit(130)
+    finally:
+        results.close()
+    executor.shutdown()
+    print(f"Completed {done}, failed {failed} in {time.monotonic() - started_at:.1f}s. Results: {results_path}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()